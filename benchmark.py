@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
+(See accompanying LICENSE file for details.)
+
+Benchmarks for the performance-sensitive parts of Taurus. Run with the names
+of benchmarks (see --help for the list), or "all"; each prints its own
+results. Results can also be saved as JSON, and compared with saved ones to
+catch regressions.
+"""
+
+import atexit
+import collections
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
+
+import ciphersaber2
+import store
+
+
+# Where the daemon lives, so it can be started from anywhere.
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+TAURUSD = os.path.join(SOURCE_DIR, "taurusd.py")
+
+# The baseline results kept with the source, for --compare.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc", "benchmark_baseline.json")
+
+# Rounds of key scheduling and message sizes (in bytes) to time the
+# encryption functions with.
+CRYPTO_ROUNDS = [1, 20, 200]
+CRYPTO_SIZES = [64, 1024, 16384]
+
+# The modules whose startup time is measured, whether each has a --help to
+# run as well (the client goes straight into curses), and how many times to
+# start each one, taking the best.
+STARTUP = [("taurus", False), ("taurusd", True), ("ciphersaber2", True)]
+STARTUP_RUNS = 10
+
+# How much slower (or, for rates, lower) than the baseline a result can be
+# before --compare calls it a regression.
+TOLERANCE = 0.25
+
+# Every result so far, by name, as (value, unit) pairs.
+results = collections.OrderedDict()
+
+
+def reference_schedule(key, rounds):
+    """
+    Key scheduling exactly as the original list-based implementation did it,
+    kept here as the "before" side of the comparison.
+    """
+    j = 0
+    S = range(256)
+    while rounds:
+        for i in range(256):
+            j = (j + S[i] + ord(key[i % len(key)])) % 256
+            x = S[i]
+            S[i] = S[j]
+            S[j] = x
+        rounds -= 1
+    return S
+
+
+def report(name, seconds, count):
+    """
+    Print and record the per-operation time of a benchmark run.
+    """
+    ms = seconds / count * 1000
+    results[name] = (ms, "ms/op")
+    print("{name:<32} {ms:9.3f} ms/op".format(name=name, ms=ms))
+
+
+def report_rate(name, rate):
+    """
+    Print and record a benchmark result measured in messages per second.
+    """
+    results[name] = (rate, "messages/s")
+    print("{name:<32} {rate:9.1f} messages/s".format(name=name, rate=rate))
+
+
+def best_time(function, count):
+    """
+    Time count calls of function, and return the best of three tries.
+    """
+    return min(timeit.repeat(function, number=count, repeat=3))
+
+
+def bench_ksa(args):
+    """
+    Per-message key scheduling cost with the TauNet defaults: the original
+    implementation, a full schedule from scratch, and a cached context.
+    """
+    key = "password"
+    rounds = ciphersaber2.ROUNDS
+    ivs = [ciphersaber2.random_iv() for i in range(args.n)]
+    ctx = ciphersaber2.context(key, rounds)
+    assert bytearray(reference_schedule(key + ivs[0], rounds)) == ctx.schedule(ivs[0])
+
+    def run(schedule):
+        return timeit.timeit(lambda: [schedule(iv) for iv in ivs], number=1)
+
+    report("ksa reference", run(lambda iv: reference_schedule(key + iv, rounds)), args.n)
+    report("ksa uncached", run(lambda iv: ciphersaber2._schedule(key + iv, rounds)), args.n)
+    report("ksa context", run(ctx.schedule), args.n)
+
+
+def bench_crypto(args):
+    """
+    Keystream generation, encryption and decryption, at each combination of
+    CRYPTO_ROUNDS and CRYPTO_SIZES. Larger sizes are run fewer times.
+    """
+    key = "password"
+    for rounds in CRYPTO_ROUNDS:
+        ciphersaber2.context(key, rounds)
+        for size in CRYPTO_SIZES:
+            count = max(1, args.n * 1024 // max(size, 1024))
+            message = "x" * size
+            ciphertext = ciphersaber2.encrypt(message, key, rounds)
+            label = "{rounds} rounds {size}B".format(rounds=rounds, size=size)
+            report("keystream " + label, best_time(lambda: ciphersaber2.keystream(size, key, rounds), count), count)
+            report("encrypt " + label, best_time(lambda: ciphersaber2.encrypt(message, key, rounds), count), count)
+            report("decrypt " + label, best_time(lambda: ciphersaber2.decrypt(ciphertext, key, rounds), count), count)
+
+
+def bench_parse(args):
+    """
+    Building and parsing TauNet messages: the headers alone, and whole
+    messages including encryption. The user table isn't needed for any of it.
+    """
+    import taunet
+    message = "x" * taunet.MAX_MESSAGE
+    tnm = taunet.TauNetMessage().outgoing(taunet.USERNAME, message)
+    cleartext = bytearray(tnm.build_headers() + message)
+    report("build headers", best_time(tnm.build_headers, args.n), args.n)
+    report("parse headers", best_time(lambda: taunet.TauNetMessage().parse_headers(cleartext), args.n), args.n)
+    report("outgoing message", best_time(lambda: taunet.TauNetMessage().outgoing(taunet.USERNAME, message), args.n), args.n)
+    report("incoming message", best_time(lambda: taunet.TauNetMessage().incoming(tnm.ciphertext), args.n), args.n)
+    report("incoming headers only", best_time(lambda: taunet.TauNetMessage().incoming_headers(tnm.ciphertext), args.n), args.n)
+
+
+def start_time(command):
+    """
+    Run a command (a list of arguments to Python) from the source directory
+    STARTUP_RUNS times, and return the shortest time it took, in seconds.
+    """
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for i in range(STARTUP_RUNS):
+            started = time.time()
+            subprocess.check_call([sys.executable] + command, cwd=SOURCE_DIR, stdout=devnull)
+            times.append(time.time() - started)
+    return min(times)
+
+
+def bench_startup(args):
+    """
+    How long a new Python process takes to import each of the programs, and
+    to run their --help, against a sandboxed home directory. These include
+    starting Python itself, which is measured too for comparison.
+    """
+    sandbox(args.peers)
+    report("startup python", start_time(["-c", "pass"]), 1)
+    for module, has_help in STARTUP:
+        report("startup import " + module, start_time(["-c", "import " + module]), 1)
+        if has_help:
+            report("startup {0} --help".format(module), start_time([module + ".py", "--help"]), 1)
+
+
+def sandbox(peers):
+    """
+    Point HOME at a new temporary directory containing a Taurus directory and
+    a user table of the given number of peers, all on loopback. This has to
+    happen before taunet or filesystem are imported. Returns the messages
+    directory. The directory is removed, and HOME put back, on exit.
+    """
+    home = tempfile.mkdtemp(prefix="taurus-bench-")
+    atexit.register(remove_sandbox, home, os.environ.get("HOME"))
+    message_dir = os.path.join(home, ".taurus", "messages")
+    os.makedirs(message_dir)
+    with open(os.path.join(home, ".taurus", "users.csv"), "w") as f:
+        for i in range(peers):
+            f.write("peer{i},127.0.0.1,6283\n".format(i=i))
+    os.environ["HOME"] = home
+    return message_dir
+
+
+def remove_sandbox(home, previous):
+    """
+    Remove a directory made by sandbox(), and point HOME back where it was.
+    """
+    shutil.rmtree(home, ignore_errors=True)
+    if previous == None:
+        os.environ.pop("HOME", None)
+    else:
+        os.environ["HOME"] = previous
+
+
+def forge(sender, message):
+    """
+    Encrypt a TauNet message from the given sender to us, as that sender's
+    client would have.
+    """
+    import taunet
+    tnm = taunet.TauNetMessage()
+    tnm.version = taunet.VERSION
+    tnm.sender = sender
+    tnm.recipient = taunet.USERNAME
+    return ciphersaber2.encrypt(tnm.build_headers() + message, taunet.KEY)
+
+
+def free_port():
+    """
+    Find a port nothing is listening on.
+    """
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_daemon(workers, port, connections):
+    """
+    Start taurusd on the given port and wait until it's accepting connections.
+    Its admission control is relaxed for a load test: every peer is on
+    loopback, so rate limiting would throttle the lot, and it's allowed the
+    given number of connections at once.
+    """
+    proc = subprocess.Popen([sys.executable, TAURUSD, "-w", str(workers), "-p", str(port), "--rate", "0", "--known-rate", "0", "--max-connections", str(connections)])
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except socket.error:
+            assert proc.poll() == None, "taurusd exited during startup."
+            time.sleep(0.05)
+
+
+def send(port, ciphertext):
+    """
+    Deliver one ciphertext to the daemon on the given port.
+    """
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(ciphertext)
+    s.shutdown(socket.SHUT_RDWR)
+    s.close()
+
+
+def count_messages(directory):
+    """
+    Count the messages stored in all the conversations in the given directory.
+    """
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith(store.DATA_SUFFIX):
+            total += len(store.ConversationStore(os.path.join(directory, name[:-len(store.DATA_SUFFIX)])))
+    return total
+
+
+def bench_daemon(args):
+    """
+    Messages per second through taurusd with each number of workers, from
+    simulated peers on loopback sending concurrently.
+    """
+    message_dir = sandbox(args.peers)
+    payload = "x" * 900
+    messages = [forge("peer{i}".format(i=i % args.peers), payload) for i in range(args.n)]
+    senders = ThreadPool(args.c)
+    for workers in args.workers:
+        for name in os.listdir(message_dir):
+            os.remove(os.path.join(message_dir, name))
+        port = free_port()
+        # Every message might be waiting to be accepted at once.
+        proc = start_daemon(workers, port, args.n + 1)
+        try:
+            start = time.time()
+            senders.map(lambda m: send(port, m), messages)
+            while count_messages(message_dir) < args.n:
+                assert time.time() - start < 60, "Timed out waiting for messages to be written."
+                time.sleep(0.01)
+            elapsed = time.time() - start
+        finally:
+            proc.send_signal(signal.SIGINT)
+            proc.wait()
+        report_rate("daemon {workers} worker(s)".format(workers=workers), args.n / elapsed)
+
+
+def save(filename):
+    """
+    Write the results so far to a JSON file.
+    """
+    with open(filename, "w") as f:
+        json.dump({
+            "python": sys.version.split()[0],
+            "results": dict((name, {"value": value, "unit": unit}) for name, (value, unit) in results.items()),
+        }, f, indent=2, separators=(",", ": "), sort_keys=True)
+        f.write("\n")
+
+
+def compare(filename, tolerance = TOLERANCE):
+    """
+    Compare the results so far with those saved in a JSON file, and print
+    the change in each one. Returns the names of results which are worse
+    than the saved ones by more than tolerance (a fraction).
+    """
+    with open(filename, "r") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    print("")
+    print("Compared with {filename}:".format(filename=filename))
+    for name, (value, unit) in results.items():
+        if name not in baseline or not baseline[name]["value"]:
+            continue
+        old = baseline[name]["value"]
+        change = (value - old) / old
+        # Times should go down, and rates up.
+        worse = change > tolerance if unit == "ms/op" else change < -tolerance
+        if worse:
+            regressions.append(name)
+        print("{name:<32} {change:+8.1%}{flag}".format(name=name, change=change, flag="  REGRESSION" if worse else ""))
+    return regressions
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("ksa", bench_ksa),
+    ("crypto", bench_crypto),
+    ("parse", bench_parse),
+    ("daemon", bench_daemon),
+    ("startup", bench_startup),
+])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run Taurus benchmarks.")
+    parser.add_argument("benchmark", nargs="+", choices=list(BENCHMARKS) + ["all"], help="Which benchmarks to run.")
+    parser.add_argument("-n", type=int, default=200, help="Number of operations to time.")
+    parser.add_argument("-c", type=int, default=16, help="Number of concurrent senders (daemon).")
+    parser.add_argument("--peers", type=int, default=60, help="Number of simulated peers (daemon).")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare (daemon).")
+    parser.add_argument("--json", metavar="FILE", help="Save the results to FILE as JSON.")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=BASELINE, help="Compare the results with those saved in FILE (default {0}), and exit with an error if any are worse by more than the tolerance.".format(os.path.relpath(BASELINE)))
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Fraction by which a result may be worse than the saved one (default {0}).".format(TOLERANCE))
+    args = parser.parse_args()
+    names = list(BENCHMARKS) if "all" in args.benchmark else args.benchmark
+    for name in names:
+        BENCHMARKS[name](args)
+    if args.json:
+        save(args.json)
+    if args.compare and compare(args.compare, args.tolerance):
+        sys.exit(1)
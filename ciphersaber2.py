@@ -8,50 +8,97 @@ The functions in this file are based on Bart Massey's pseudocode:
 https://github.com/BartMassey/ciphersaber2
 """
 
-import random
-import time
+import collections
+import os
+import threading
 
 
-# Use OS-provided randomness instead of only software.
-urandom = random.SystemRandom(time.clock())
-
 # These are just defaults, based on the CipherSaber2 specification.
 # They can be overridden in the actual function calls.
 IV_LENGTH = 10
 ROUNDS = 20
 
+# How much to read at a time when streaming.
+CHUNK_SIZE = 65536
 
-def keystream(stream_length, key, rounds = None):
+
+def _key_pairs(key):
     """
-    Generate an RC4 keystream of the given length, doing a specified number
-    of rounds of key scheduling and encrypting with the key provided.
+    Pair each key scheduling position (0-255) with the key byte used there,
+    so the scheduling loop doesn't need to index the key modulo its length.
     """
-    if rounds == None:
-        rounds = ROUNDS
+    K = bytearray(key)
+    return list(enumerate((K * (256 // len(K) + 1))[:256]))
+
 
-    # Do key scheduling.
+def _ksa(S, pairs, j):
+    """
+    Do one round of key scheduling on the state S in place, using the
+    (position, key byte) pairs provided. Returns the new value of j.
+    """
+    for i, k in pairs:
+        x = S[i]
+        j = (j + x + k) & 255
+        S[i] = S[j]
+        S[j] = x
+    return j
+
+
+def _schedule(key, rounds):
+    """
+    Do the specified number of rounds of RC4 key scheduling with the key
+    provided, and return the resulting state as a bytearray.
+    """
+    S = bytearray(range(256))
+    pairs = _key_pairs(key)
     j = 0
-    S = range(256)
     while rounds:
-        for i in range(256):
-            j = (j + S[i] + ord(key[i % len(key)])) % 256
-            x = S[i]
-            S[i] = S[j]
-            S[j] = x
+        j = _ksa(S, pairs, j)
         rounds -= 1
+    return S
 
-    # Produce the actual stream.
-    stream = []
-    j = 0
-    for i in range(stream_length):
-        k = (i + 1) % 256
-        j = (j + S[k]) % 256
-        x = S[k]
-        S[k] = S[j]
-        S[j] = x
-        stream.append(S[(S[k] + S[j]) % 256])
 
-    return stream
+class _Generator(object):
+    """
+    The RC4 output generator for a scheduled state. Keeps its position in
+    the keystream, so a message can be processed a piece at a time.
+    """
+    def __init__(self, S):
+        self.S = S
+        self.k = 0
+        self.j = 0
+
+    def crypt(self, buf, start = 0):
+        """
+        XOR the next bytes of keystream into the bytearray buf (from position
+        start onward) in place, and return it.
+        """
+        S = self.S
+        j = self.j
+        k = self.k
+        for n in range(start, len(buf)):
+            k = (k + 1) & 255
+            x = S[k]
+            j = (j + x) & 255
+            y = S[j]
+            S[k] = y
+            S[j] = x
+            buf[n] ^= S[(x + y) & 255]
+        self.j = j
+        self.k = k
+        return buf
+
+
+def keystream(stream_length, key, rounds = None):
+    """
+    Generate an RC4 keystream of the given length, doing a specified number
+    of rounds of key scheduling and encrypting with the key provided.
+    The stream is returned as a bytearray.
+    """
+    if rounds == None:
+        rounds = ROUNDS
+    # XORing the keystream into zeroes leaves just the keystream.
+    return _Generator(_schedule(key, rounds)).crypt(bytearray(stream_length))
 
 
 def random_iv(length = None):
@@ -60,10 +107,111 @@ def random_iv(length = None):
     """
     if length == None:
         length = IV_LENGTH
-    iv = ""
-    for i in range(length):
-        iv += (chr(urandom.randrange(256)))
-    return iv
+    # Use OS-provided randomness instead of only software.
+    return os.urandom(length)
+
+
+class CipherSaber2Context(object):
+    """
+    Key scheduling state for a fixed key and number of rounds, which can be
+    reused for every message encrypted or decrypted with that key.
+
+    CipherSaber2 schedules with the key followed by the IV, so the first
+    len(key) steps of the first round never see the IV. Those are done once
+    here and the result is copied for each IV, rather than being redone.
+    Everything after that depends on the IV and still runs per message.
+    """
+    def __init__(self, key, rounds = None):
+        if rounds == None:
+            rounds = ROUNDS
+        self.key = key
+        self.rounds = rounds
+        self.prefix = bytearray(range(256))
+        self.prefix_j = 0
+        self.prefix_length = min(len(key), 256) if rounds else 0
+        if self.prefix_length:
+            self.prefix_j = _ksa(self.prefix, _key_pairs(key)[:self.prefix_length], 0)
+
+    def schedule(self, iv):
+        """
+        Return the scheduled RC4 state for this context's key with the given
+        IV appended, as a new bytearray.
+        """
+        S = bytearray(self.prefix)
+        if not self.rounds:
+            return S
+        pairs = _key_pairs(self.key + iv)
+        j = _ksa(S, pairs[self.prefix_length:], self.prefix_j)
+        for r in range(self.rounds - 1):
+            j = _ksa(S, pairs, j)
+        return S
+
+    def encrypt(self, message, iv = None, iv_length = None):
+        """
+        Encrypt a message with this context's key. Creates a random IV if
+        none was provided.
+        """
+        if iv == None:
+            iv = random_iv(iv_length)
+        # Build the output in one buffer: the IV, then the message encrypted
+        # in place right after it.
+        buf = bytearray(iv)
+        buf.extend(message)
+        return bytes(self.encrypt_buffer(buf, len(iv)))
+
+    def encrypt_buffer(self, buf, iv_length = None):
+        """
+        Encrypt in place a bytearray holding an IV of the given length (or
+        the default) followed by a message, so that it holds the ciphertext.
+        Returns buf.
+        """
+        if iv_length == None:
+            iv_length = IV_LENGTH
+        iv = bytes(buf[:iv_length])
+        return _Generator(self.schedule(iv)).crypt(buf, iv_length)
+
+    def decrypt(self, ciphertext, iv_length = None):
+        """
+        Decrypt a message with this context's key. If no IV length is
+        provided, assumes the default.
+        """
+        return bytes(self.decrypt_buffer(ciphertext, iv_length))
+
+    def decrypt_buffer(self, ciphertext, iv_length = None):
+        """
+        Decrypt a message like decrypt(), but return the cleartext as a
+        bytearray, without copying it into a string.
+        """
+        if iv_length == None:
+            iv_length = IV_LENGTH
+        iv = ciphertext[:iv_length]
+        buf = bytearray(memoryview(ciphertext)[iv_length:])
+        return _Generator(self.schedule(iv)).crypt(buf)
+
+
+# Recently-used contexts, most recent last, and how many to keep. The lock
+# is held while the cache is looked up and changed, since several threads
+# may be encrypting at once.
+_contexts = collections.OrderedDict()
+_contexts_lock = threading.Lock()
+MAX_CONTEXTS = 8
+
+
+def context(key, rounds = None):
+    """
+    Fetch the CipherSaber2Context for the given key and number of rounds,
+    creating it if it isn't among the most recently used ones.
+    """
+    if rounds == None:
+        rounds = ROUNDS
+    with _contexts_lock:
+        ctx = _contexts.pop((key, rounds), None)
+        if ctx == None:
+            ctx = CipherSaber2Context(key, rounds)
+            while len(_contexts) >= MAX_CONTEXTS:
+                _contexts.popitem(last=False)
+        _contexts[(key, rounds)] = ctx
+    return ctx
 
 
 def encrypt(message, key, rounds = None, iv = None, iv_length = None):
@@ -71,17 +219,7 @@ def encrypt(message, key, rounds = None, iv = None, iv_length = None):
     Encrypt a message with the given key, doing the specified number of rounds
     of key scheduling. Creates a random IV if none was provided.
     """
-    if rounds == None:
-        rounds = ROUNDS
-    if iv_length == None:
-        iv_length = IV_LENGTH
-    if iv == None:
-        iv = random_iv(iv_length)
-    stream = keystream(len(message), key+iv, rounds)
-    ciphertext = ""
-    for i in range(len(message)):
-        ciphertext += chr(ord(message[i]) ^ stream[i])
-    return iv + ciphertext
+    return context(key, rounds).encrypt(message, iv, iv_length)
 
 
 def decrypt(ciphertext, key, rounds = None, iv_length = None):
@@ -89,17 +227,115 @@ def decrypt(ciphertext, key, rounds = None, iv_length = None):
     Decrypt a message with the given key, doing the specified number of rounds
     of key scheduling. If no IV length is provided, assumes the default.
     """
-    if rounds == None:
-        rounds = ROUNDS
-    if iv_length == None:
-        iv_length = IV_LENGTH
-    iv = ciphertext[:iv_length]
-    ciphertext = ciphertext[iv_length:]
-    stream = keystream(len(ciphertext), key+iv, rounds)
-    plaintext = ""
-    for i in range(len(ciphertext)):
-        plaintext += chr(ord(ciphertext[i]) ^ stream[i])
-    return plaintext
+    return context(key, rounds).decrypt(ciphertext, iv_length)
+
+
+class Encryptor(object):
+    """
+    Encrypt a message incrementally. Pass each piece of the message to
+    update(), which returns the corresponding ciphertext (preceded by the IV
+    the first time), then call finalize() to get anything remaining.
+    """
+    def __init__(self, key, rounds = None, iv = None, iv_length = None):
+        if iv == None:
+            iv = random_iv(iv_length)
+        self.iv = iv
+        self.generator = _Generator(context(key, rounds).schedule(iv))
+        self.started = False
+
+    def update(self, chunk):
+        """
+        Encrypt the next piece of the message and return the ciphertext.
+        """
+        ciphertext = bytes(self.generator.crypt(bytearray(chunk)))
+        if not self.started:
+            self.started = True
+            return self.iv + ciphertext
+        return ciphertext
+
+    def finalize(self):
+        """
+        Finish the message. Only returns anything (the IV) if the message
+        was empty.
+        """
+        return self.update("") if not self.started else ""
+
+
+class Decryptor(object):
+    """
+    Decrypt a message incrementally. Pass each piece of the ciphertext to
+    update(), which returns whatever cleartext is available so far, then call
+    finalize() to get anything remaining.
+    """
+    def __init__(self, key, rounds = None, iv_length = None):
+        if iv_length == None:
+            iv_length = IV_LENGTH
+        self.context = context(key, rounds)
+        self.iv_length = iv_length
+        self.iv = ""
+        self.generator = None
+
+    def update(self, chunk):
+        """
+        Decrypt the next piece of the ciphertext and return the cleartext.
+        Returns an empty string until the whole IV has been received.
+        """
+        return bytes(self.update_buffer(chunk))
+
+    def update_buffer(self, chunk):
+        """
+        Decrypt the next piece of the ciphertext like update(), but return
+        the cleartext as a bytearray.
+        """
+        if self.generator == None:
+            needed = self.iv_length - len(self.iv)
+            self.iv += chunk[:needed]
+            if len(self.iv) < self.iv_length:
+                return bytearray()
+            self.generator = _Generator(self.context.schedule(self.iv))
+            chunk = memoryview(chunk)[needed:]
+        return self.generator.crypt(bytearray(chunk))
+
+    def finalize(self):
+        """
+        Finish the message. Since RC4 is a stream cipher, all the cleartext
+        has already been returned by update().
+        """
+        return ""
+
+
+def read_chunks(f, size = None):
+    """
+    Yield the contents of a file object in pieces of the given size (or the
+    default), until EOF.
+    """
+    if size == None:
+        size = CHUNK_SIZE
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def encrypt_stream(chunks, key, rounds = None, iv = None, iv_length = None):
+    """
+    Encrypt an iterable of message pieces, yielding ciphertext pieces.
+    """
+    encryptor = Encryptor(key, rounds, iv, iv_length)
+    for chunk in chunks:
+        yield encryptor.update(chunk)
+    yield encryptor.finalize()
+
+
+def decrypt_stream(chunks, key, rounds = None, iv_length = None):
+    """
+    Decrypt an iterable of ciphertext pieces, yielding cleartext pieces.
+    """
+    decryptor = Decryptor(key, rounds, iv_length)
+    for chunk in chunks:
+        yield decryptor.update(chunk)
+    yield decryptor.finalize()
 
 
 def run_tests():
@@ -118,6 +354,8 @@ def run_tests():
     print("Different input, different output.")
     assert len(keystream(42, "testkey", 200)) == 42
     print("Requested 42 bytes of stream, got 42 bytes of stream.")
+    assert keystream(42, "testkey", 200)[:10] == stream
+    print("Shorter stream is a prefix of the longer one.")
 
     print("-- Testing encryption. --")
     print("Encrypting 'fish', 200 rounds, key 'testkey', IV 'badiv'")
@@ -146,9 +384,41 @@ def run_tests():
     assert "fish" == decrypt(cipher, "testkey", ROUNDS, IV_LENGTH)
     print("Constants match.")
 
+    print("-- Testing contexts. --")
+    ctx = context("testkey", 200)
+    assert ctx is context("testkey", 200)
+    print("Same key and rounds, same context.")
+    assert ctx.schedule("badiv") == _schedule("testkeybadiv", 200)
+    print("Context schedule matches full key scheduling.")
+    assert ctx.encrypt("fish", "badiv") == encrypt("fish", "testkey", 200, "badiv")
+    print("Context encryption matches.")
+    buf = ctx.encrypt_buffer(bytearray("badivfish"), 5)
+    assert buf == encrypt("fish", "testkey", 200, "badiv")
+    assert ctx.decrypt_buffer(bytes(buf), 5) == bytearray("fish")
+    print("Encrypting and decrypting buffers in place match.")
+    for i in range(MAX_CONTEXTS):
+        context("testkey", i)
+    assert len(_contexts) == MAX_CONTEXTS
+    assert ctx is not context("testkey", 200)
+    print("Least recently used context was evicted.")
+
+    print("-- Testing streaming. --")
+    message = "a longer message, to be split up into pieces"
+    cipher = encrypt(message, "testkey", 200, "badiv")
+    pieces = [message[i:i+7] for i in range(0, len(message), 7)]
+    assert cipher == "".join(encrypt_stream(pieces, "testkey", 200, "badiv"))
+    print("Encrypting in pieces matches encrypting all at once.")
+    pieces = [cipher[i:i+3] for i in range(0, len(cipher), 3)]
+    assert message == "".join(decrypt_stream(pieces, "testkey", 200, 5))
+    print("Decrypting in pieces (splitting the IV) matches.")
+    assert "badiv" == "".join(encrypt_stream([], "testkey", 200, "badiv"))
+    print("Empty stream encrypts to just the IV.")
+
     print("-- Testing algorithm. --")
     assert "Al Dakota buys" == encrypt("mead", "Al", 20, "Al Dakota ")
     print("Human-readable sample works.")
+    assert "mead" == decrypt("Al Dakota buys", "Al", 20)
+    print("Human-readable sample decrypts.")
 
 
 def interact(args):
@@ -163,6 +433,15 @@ def interact(args):
         print("No key specified. Please add --key, or use --help or --test.")
         return
 
+    if args.s:
+        if args.d:
+            output = decrypt_stream(read_chunks(sys.stdin, args.c), args.key, args.r, args.l)
+        else:
+            output = encrypt_stream(read_chunks(sys.stdin, args.c), args.key, args.r, args.iv, args.l)
+        for chunk in output:
+            sys.stdout.write(chunk)
+        return
+
     if args.d:
         sys.stdout.write(decrypt(sys.stdin.read(), args.key, args.r, args.l))
         return
@@ -188,4 +467,6 @@ if __name__ == "__main__":
     parser.add_argument("-d", action="store_true", help="Decrypt stdin instead of encrypting.")
     parser.add_argument("-r", type=int, default=None, help="Specify a number of rounds of key scheduling.")
     parser.add_argument("-l", type=int, default=None, help="Specify an expected IV length. (Ignored if IV is given.)")
+    parser.add_argument("-s", action="store_true", help="Stream stdin to stdout a chunk at a time, instead of reading it all first.")
+    parser.add_argument("-c", type=int, default=None, help="Specify the chunk size for streaming, in bytes (default {}).".format(CHUNK_SIZE))
     interact(parser.parse_args())
@@ -12,57 +12,589 @@ import os
 import fcntl
 import time
 import logging
+import atexit
+import threading
+import Queue
+import errno
+import select
+import struct
+import json
 
+import store
 
-# Ensure base directory exists.
-TAURUS_DIR = os.path.expanduser("~/.taurus")
-assert os.path.isdir(TAURUS_DIR), "Taurus directory {0} does not exist.".format(TAURUS_DIR)
 
-# Ensure message directory exists.
+# The base directory, and the message directory inside it. Both are checked
+# for (by check_dirs) the first time something needs them, not on import.
+TAURUS_DIR = os.path.expanduser("~/.taurus")
 MESSAGE_DIR = os.path.join(TAURUS_DIR, "messages")
-assert os.path.isdir(MESSAGE_DIR), "Message directory {0} does not exist.".format(MESSAGE_DIR)
 
-# Set up the common logger configuration.
+# The common logger configuration, which is set up by the first get_logger.
 LOG_FILE = os.path.join(TAURUS_DIR, "taurus.log")
 LOG_FORMAT = "%(asctime)s %(levelname)s (%(name)s): %(message)s"
 LOG_LEVEL = logging.DEBUG
-logging.basicConfig(level=LOG_LEVEL, filename=LOG_FILE, format=LOG_FORMAT)
 
+# Settings for queued logging (see start_log_queue): the size the log may
+# reach before it's rotated, how many old logs to keep, and how many records
+# may be waiting to be written before new ones are dropped.
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000
+
+# The cache of conversation metadata (see MetadataCache), and how many times
+# as many lines as conversations its log may have before it's rewritten.
+METADATA_FILE = os.path.join(TAURUS_DIR, "conversations.meta")
+METADATA_COMPACT = 4
+
+# inotify flags, from <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_EVENT = struct.Struct("iIII")
+
+# Range of delays between checks when inotify isn't available. The delay
+# doubles each time nothing has changed.
+POLL_MIN = 0.01
+POLL_MAX = 1.0
+
+
+# Whether check_dirs and configure_logging have done their work yet.
+_dirs_checked = [False]
+_logging_configured = [False]
+
+def check_dirs():
+    """
+    Ensure the base and message directories exist. Only the first call
+    actually checks.
+    """
+    if _dirs_checked[0]:
+        return
+    assert os.path.isdir(TAURUS_DIR), "Taurus directory {0} does not exist.".format(TAURUS_DIR)
+    assert os.path.isdir(MESSAGE_DIR), "Message directory {0} does not exist.".format(MESSAGE_DIR)
+    _dirs_checked[0] = True
+
+def configure_logging():
+    """
+    Set up the common logger configuration, writing to LOG_FILE, unless
+    it's already been done.
+    """
+    if _logging_configured[0]:
+        return
+    check_dirs()
+    logging.basicConfig(level=LOG_LEVEL, filename=LOG_FILE, format=LOG_FORMAT)
+    _logging_configured[0] = True
 
 def get_logger(name):
     """
-    Utility function to retrieve logger objects for other modules.
+    Utility function to retrieve logger objects for other modules. The
+    first call configures logging.
     """
+    configure_logging()
     return logging.getLogger(name)
 
+def set_log_level(level):
+    """
+    Change the level of messages which are logged, for every module.
+    """
+    logging.getLogger().setLevel(level)
+
+class QueueHandler(logging.Handler):
+    """
+    A logging handler which puts records on a queue for a QueueListener to
+    write, rather than writing them itself. Records are formatted by the
+    listener too. If the queue is full, records are dropped and counted
+    rather than waiting.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+class QueueListener(object):
+    """
+    Takes records off a queue in a background thread, and passes them to the
+    given handlers.
+    """
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        """
+        Start handling records in a background thread.
+        """
+        self.thread = threading.Thread(target=self.run, name="logging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Handle records until the stop marker comes off the queue.
+        """
+        while True:
+            record = self.queue.get()
+            if record == None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Handle everything already queued, then stop.
+        """
+        if self.thread != None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            for handler in self.handlers:
+                handler.close()
+
+def start_log_queue():
+    """
+    Switch logging to go through a queue, so that logging a message never
+    waits for the disk. The log is written by a background thread, and
+    rotated when it reaches LOG_MAX_BYTES. Returns the QueueHandler, which
+    counts any records dropped because the queue was full.
+    """
+    # Only the daemon logs this way, so only it needs these.
+    import logging.handlers
+    check_dirs()
+    _logging_configured[0] = True
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    writer = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue = Queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    handler = QueueHandler(queue)
+    root.addHandler(handler)
+    return handler
+
+def log_to_file():
+    """
+    Switch logging back to writing LOG_FILE directly, in a process forked
+    after start_log_queue: its queue's listener thread didn't survive the
+    fork, so records put on it would never be written. The file is reopened
+    if the daemon rotates it.
+    """
+    import logging.handlers
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    writer = logging.handlers.WatchedFileHandler(LOG_FILE)
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(writer)
+
+def conversation_store(conversation):
+    """
+    Return the ConversationStore for the named conversation. If there's an
+    old plain-text file for it, its contents are imported first.
+    """
+    check_dirs()
+    path = os.path.join(MESSAGE_DIR, conversation)
+    if os.path.isfile(path):
+        import_text(conversation)
+    return store.ConversationStore(path)
+
+def import_text(conversation):
+    """
+    Move the messages from an old plain-text conversation file into the
+    conversation's store, and rename the text file with a .txt suffix.
+    Lines which don't start a new message are taken to be a continuation of
+    the one before, and timestamps which can't be read get the time of the
+    message before (or the file's modification time). If another process
+    imports the file first, this does nothing.
+    """
+    filename = os.path.join(MESSAGE_DIR, conversation)
+    records = []
+    try:
+        f = open(filename, "r")
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        st = os.fstat(f.fileno())
+        try:
+            current = os.stat(filename).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            current = None
+        if current != st.st_ino:
+            # Someone else imported it (and renamed it) while we waited.
+            return
+        last_time = st.st_mtime
+        for line in f:
+            line = line.rstrip("\n")
+            stamp, bracket, rest = line[1:].partition("] ")
+            sender, colon, message = rest.partition(": ")
+            if not (line.startswith("[") and bracket and colon):
+                if records:
+                    t, sender, message = records[-1]
+                    records[-1] = (t, sender, message + "\n" + line)
+                continue
+            try:
+                last_time = time.mktime(time.strptime(stamp, "%c"))
+            except ValueError:
+                pass
+            records.append((last_time, sender, message))
+        if records:
+            store.ConversationStore(filename).append_many(records)
+        os.rename(filename, filename + ".txt")
+        fcntl.flock(f, fcntl.LOCK_UN)
+    get_logger("filesystem").info("Imported {n} messages from {filename}.".format(n=len(records), filename=filename))
+
 def write_message(conversation, tnm):
     """
     Write a TauNet message to the appropriate conversation in the message
     directory. tnm should be a valid TauNetMessage object, and conversation
-    the name of the conversation file which should be updated (normally the
+    the name of the conversation which should be updated (normally the
     name of the non-local user: the sender of incoming messages, and the
-    recipient of outgoing ones).
+    recipient of outgoing ones). The message is added to the search index
+    and the metadata cache too. Returns the name of the file written.
     """
-    filename = os.path.join(MESSAGE_DIR, conversation)
-    line = "[{time}] {sender}: {message}\n".format(time=time.strftime("%c"), sender=tnm.sender, message=tnm.message)
-    with open(filename, "a") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
-        f.write(line)
-        fcntl.flock(f, fcntl.LOCK_UN)
-    return filename
+    messages = conversation_store(conversation)
+    messages.append(tnm.sender, tnm.message)
+    # Our own messages, and anything before them, count as read.
+    metadata.written(conversation, messages, read=tnm.sender != conversation)
+    # search needs this module, so it can't be imported at the top.
+    import search
+    try:
+        search.update([conversation])
+    except (IOError, OSError, ValueError):
+        get_logger("filesystem").exception("Failed to update the search index.")
+    return messages.data_path
 
 def conversations():
     """
-    Return a list of the filenames of all conversations available for viewing.
+    Return a list of the names of all conversations available for viewing.
+    """
+    check_dirs()
+    names = set()
+    for filename in os.listdir(MESSAGE_DIR):
+        name, suffix = os.path.splitext(filename)
+        if suffix == store.DATA_SUFFIX:
+            names.add(name)
+        elif suffix not in (store.INDEX_SUFFIX, ".txt"):
+            # An old plain-text conversation, which hasn't been imported yet.
+            names.add(filename)
+    return sorted(names)
+
+class ConversationInfo(object):
+    """
+    What the metadata cache knows about a conversation: how many messages
+    it has, the time of the last one, and how many have been read.
+    """
+    __slots__ = ("name", "count", "last", "read")
+
+    def __init__(self, name, count = 0, last = 0, read = 0):
+        self.name = name
+        self.count = count
+        self.last = last
+        self.read = read
+
+    def unread(self):
+        """
+        The number of messages which haven't been read.
+        """
+        return max(0, self.count - self.read)
+
+class MetadataCache(object):
+    """
+    The message count, last message time and number of messages read of
+    every conversation, so they can be listed without opening each one.
+    The cache is a log of JSON lines, one per change, the latest for each
+    conversation winning. Changes are appended under a lock, and the log is
+    rewritten with one line per conversation when it gets METADATA_COMPACT
+    times longer than that. Readers don't need the lock, and only read what
+    has been added since they last looked. If there's no cache yet, it's
+    built from the conversations themselves, taking every message as read.
+    """
+    def __init__(self, path = METADATA_FILE):
+        self.path = path
+        self.info = {}
+        # How far the log has been read, how many lines that was, and
+        # which file it was (so a rewritten one is read from the start).
+        self.position = 0
+        self.lines = 0
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def _read(self):
+        """
+        Read any complete lines added to the log since last time. Returns
+        False if there's no log.
+        """
+        try:
+            f = open(self.path, "r")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.position:
+                self.info = {}
+                self.position = 0
+                self.lines = 0
+                self.inode = st.st_ino
+            f.seek(self.position)
+            data = f.read()
+        end = data.rfind("\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                name, count, last, read = json.loads(line)
+            except ValueError:
+                # Part of a line left by a crash.
+                continue
+            name = name.encode("utf-8")
+            self.info[name] = ConversationInfo(name, count, last, read)
+            self.lines += 1
+        self.position += end
+        return True
+
+    def _rewrite(self, infos):
+        """
+        Replace the log with one line for each ConversationInfo given. Needs
+        the write lock.
+        """
+        with open(self.path + ".tmp", "w") as f:
+            f.write("".join(self._line(info) for info in infos))
+        os.rename(self.path + ".tmp", self.path)
+        self._read()
+
+    def _line(self, info):
+        return json.dumps([info.name, info.count, info.last, info.read]) + "\n"
+
+    def _rebuild(self):
+        """
+        Build the cache from the conversations. Needs the write lock.
+        """
+        infos = []
+        for name in conversations():
+            conversation = conversation_store(name)
+            count = len(conversation)
+            last = conversation.entry(count - 1)[0] if count else 0
+            conversation.close()
+            infos.append(ConversationInfo(name, count, last, count))
+        self._rewrite(infos)
+
+    def load(self):
+        """
+        Return a dictionary of conversation names to ConversationInfo
+        objects, up to date with the log.
+        """
+        with self.lock:
+            if not self._read():
+                self._update(None)
+            return dict(self.info)
+
+    def _update(self, name, count = None, last = None, read = None):
+        """
+        Record a conversation's message count, last message time and number
+        of messages read. Anything left as None stays as it was, and none of
+        them ever goes down. With no name, just make sure the cache
+        exists. Needs self.lock.
+        """
+        check_dirs()
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not self._read():
+                    self._rebuild()
+                if name == None:
+                    return
+                info = self.info.get(name) or ConversationInfo(name)
+                info = ConversationInfo(name, info.count, info.last, info.read)
+                # Conversations only grow, so a lower count or an earlier
+                # time is from a writer which raced with another and lost.
+                if count != None:
+                    info.count = max(info.count, count)
+                if last != None:
+                    info.last = max(info.last, last)
+                if read != None:
+                    info.read = max(info.read, read)
+                line = self._line(info)
+                with open(self.path, "a") as f:
+                    # Finish off any line left incomplete by a crash.
+                    if os.fstat(f.fileno()).st_size > self.position:
+                        line = "\n" + line
+                    f.write(line)
+                    f.flush()
+                    self.position = os.fstat(f.fileno()).st_size
+                self.info[name] = info
+                self.lines += 1
+                if self.lines > METADATA_COMPACT * len(self.info) + 64:
+                    self._rewrite(self.info.values())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def written(self, name, conversation, read = False):
+        """
+        Record the message count and last message time of the named
+        conversation just after appending to its ConversationStore. With
+        read, all its messages are marked read.
+        """
+        count, last = conversation.appended
+        with self.lock:
+            self._update(name, count, last, count if read else None)
+
+    def mark_read(self, name, read):
+        """
+        Record that the first read messages of a conversation have been read.
+        """
+        with self.lock:
+            self._update(name, read=read)
+
+# The cache is only read when it's first used.
+metadata = MetadataCache()
+
+class Watcher(object):
+    """
+    Waits for changes to a file, which needn't exist yet. Uses inotify (on
+    the file's directory) where it's available, and otherwise checks the
+    file's size, checking less often the longer it stays the same.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.fd = None
+        self.delay = POLL_MIN
+        self.size = self._size()
+        # These are slow to import and only needed here.
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = IN_MODIFY | IN_CREATE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, os.path.dirname(path) or ".", mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def _size(self):
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return -1
+
+    def _changed(self):
+        """
+        Read any pending events, and return whether any were for our file.
+        """
+        if self.fd == None:
+            size = self._size()
+            changed = size != self.size
+            self.size = size
+            return changed
+        changed = False
+        while True:
+            try:
+                events = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            i = 0
+            while i < len(events):
+                wd, mask, cookie, length = IN_EVENT.unpack_from(events, i)
+                i += IN_EVENT.size
+                if events[i:i+length].rstrip("\0") == self.name:
+                    changed = True
+                i += length
+
+    def wait(self, timeout = None, others = ()):
+        """
+        Block until the file changes, one of the other file objects given has
+        something to read, or timeout seconds pass (or forever, if None).
+        Returns a tuple of whether the file changed and a list of the other
+        file objects which are ready.
+        """
+        deadline = None if timeout == None else time.time() + timeout
+        while True:
+            if self.fd != None:
+                wait = None
+            else:
+                wait = self.delay
+            if deadline != None:
+                remaining = max(0, deadline - time.time())
+                wait = remaining if wait == None else min(wait, remaining)
+            watched = list(others)
+            if self.fd != None:
+                watched.append(self.fd)
+            try:
+                ready = select.select(watched, [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+            changed = (self.fd in ready or self.fd == None) and self._changed()
+            ready = [r for r in ready if r is not self.fd]
+            if changed:
+                self.delay = POLL_MIN
+            elif not ready:
+                self.delay = min(self.delay * 2, POLL_MAX)
+            if changed or ready or (deadline != None and time.time() >= deadline):
+                return changed, ready
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+def watch_conversation(conversation):
+    """
+    Return a Watcher for new messages in the named conversation.
     """
-    return sorted(os.listdir(MESSAGE_DIR))
+    return Watcher(conversation_store(conversation).index_path)
 
-def tail_conversation(conversation):
+def tail_conversation(conversation, timeout = 0):
     """
-    Yield lines from the backlog of the specified conversation. Yields an empty
-    string when EOF is encountered, but will keep trying. This is based on
-    this clever SO answer: http://stackoverflow.com/a/1703997
+    Yield lines of text from the backlog of the specified conversation, and
+    then new ones as they arrive. When there are no more messages, waits up
+    to timeout seconds for one (or forever, if None); if none comes, yields
+    an empty string, but will keep trying.
     """
-    with open(os.path.join(MESSAGE_DIR, conversation), "r") as f:
+    conversation = conversation_store(conversation)
+    watcher = None
+    n = 0
+    try:
         while True:
-            yield f.readline()
+            if n < len(conversation):
+                yield store.format_record(conversation[n])
+                n += 1
+                continue
+            if timeout == 0:
+                yield ""
+                continue
+            if watcher == None:
+                watcher = Watcher(conversation.index_path)
+                # Something may have arrived before the watch started.
+                continue
+            if not watcher.wait(timeout)[0]:
+                yield ""
+    finally:
+        if watcher != None:
+            watcher.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
+(See accompanying LICENSE file for details.)
+
+The outbound message queue. Messages which couldn't be delivered are stored,
+still encrypted, in a directory per recipient under ~/.taurus/outbox, and a
+background Sender keeps retrying them, backing off from recipients which
+stay unreachable.
+"""
+
+import os
+import threading
+import time
+
+import taunet
+import filesystem
+
+
+OUTBOX_DIR = os.path.join(filesystem.TAURUS_DIR, "outbox")
+
+# Seconds between checks of the queue, and the range of delays before trying
+# an unreachable recipient again. The delay doubles with each failure.
+TICK = 1
+RETRY_MIN = 5
+RETRY_MAX = 600
+
+# Get our logger object.
+logger = filesystem.get_logger("outbox")
+
+# Makes queue filenames unique within this process.
+_sequence = [0]
+_sequence_lock = threading.Lock()
+
+
+def enqueue(recipient, tnm):
+    """
+    Store the ciphertext of a TauNetMessage for later delivery to the named
+    recipient. Returns the filename it was stored in.
+    """
+    directory = os.path.join(OUTBOX_DIR, recipient)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with _sequence_lock:
+        _sequence[0] += 1
+        sequence = _sequence[0]
+    # Named by time queued, so they sort oldest first.
+    name = "{time:.6f}-{pid}-{seq}".format(time=time.time(), pid=os.getpid(), seq=sequence)
+    filename = os.path.join(directory, name)
+    # Write it under another name first, so a half-written message is never
+    # picked up for delivery.
+    with open(filename + ".tmp", "w") as f:
+        f.write(tnm.ciphertext)
+    os.rename(filename + ".tmp", filename)
+    logger.info("Queued a message for {user}.".format(user=recipient))
+    return filename
+
+
+def queued_time(filename):
+    """
+    Return the time a queued message was stored, from its filename.
+    """
+    return float(os.path.basename(filename).split("-", 1)[0])
+
+
+def pending():
+    """
+    Return a dictionary of recipient names to lists of the filenames of their
+    queued messages, oldest first.
+    """
+    queue = {}
+    if not os.path.isdir(OUTBOX_DIR):
+        return queue
+    for recipient in os.listdir(OUTBOX_DIR):
+        directory = os.path.join(OUTBOX_DIR, recipient)
+        names = sorted(n for n in os.listdir(directory) if not n.endswith(".tmp"))
+        if names:
+            queue[recipient] = [os.path.join(directory, n) for n in names]
+    return queue
+
+
+class Destination(object):
+    """
+    Delivery state for one recipient: when to try next, and how long to wait
+    after that if it fails again.
+    """
+    def __init__(self):
+        self.delay = 0
+        self.next_try = 0
+
+    def failed(self, now):
+        """
+        Put off the next try, for twice as long as last time.
+        """
+        self.delay = min(max(RETRY_MIN, self.delay * 2), RETRY_MAX)
+        self.next_try = now + self.delay
+
+    def succeeded(self):
+        """
+        Go back to trying every pass.
+        """
+        self.delay = 0
+        self.next_try = 0
+
+
+class Sender(object):
+    """
+    Delivers queued messages in the background. ship should be a function
+    taking a TauNetUser and a TauNetMessage, which tries to deliver it once
+    and returns whether it succeeded.
+
+    Each pass sends everything queued for a recipient in one go, oldest
+    first, and stops at that recipient's first failure.
+    """
+    def __init__(self, ship):
+        self.ship = ship
+        self.destinations = {}
+        self.delivered = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start delivering from a background thread.
+        """
+        self.thread = threading.Thread(target=self.run, name="outbox")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread after its current pass.
+        """
+        self.stopped.set()
+
+    def run(self):
+        """
+        Make a delivery pass every TICK seconds until stopped.
+        """
+        while not self.stopped.wait(TICK):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Outbox pass failed.")
+
+    def flush(self):
+        """
+        Make one delivery pass over every recipient which is due for one.
+        """
+        now = time.time()
+        for recipient, filenames in sorted(pending().items()):
+            destination = self.destinations.setdefault(recipient, Destination())
+            if destination.next_try > now:
+                continue
+            tnu = taunet.users.by_name(recipient)
+            if tnu == None:
+                # Maybe they'll be back in the user table later.
+                destination.failed(now)
+                continue
+            for filename in filenames:
+                with open(filename, "r") as f:
+                    ciphertext = f.read()
+                try:
+                    tnm = taunet.TauNetMessage().incoming(ciphertext)
+                except taunet.TauNetError as e:
+                    logger.error("Dropping unreadable queued message {filename} ('{error}').".format(filename=filename, error=str(e)))
+                    os.remove(filename)
+                    continue
+                if not self.ship(tnu, tnm):
+                    self.failures += 1
+                    destination.failed(now)
+                    logger.info("{user} still unreachable; next try in {delay} seconds.".format(user=recipient, delay=destination.delay))
+                    break
+                os.remove(filename)
+                destination.succeeded()
+                latency = time.time() - queued_time(filename)
+                self.delivered += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        """
+        Return a list of (recipient, queued message count, age of the oldest
+        in seconds, seconds until the next try) tuples for everyone with
+        queued messages.
+        """
+        now = time.time()
+        rows = []
+        for recipient, filenames in sorted(pending().items()):
+            destination = self.destinations.get(recipient, Destination())
+            rows.append((recipient, len(filenames), now - queued_time(filenames[0]), max(0, destination.next_try - now)))
+        return rows
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
+(See accompanying LICENSE file for details.)
+
+A full-text index of the messages in every conversation, kept in
+~/.taurus/index and brought up to date incrementally as messages are written.
+
+Each word's postings (which messages contain it, and how many times) are
+appended to one of SHARDS files, chosen by a hash of the word, so a search
+only reads the shards for the words it's looking for. A message is identified
+by its conversation (a number, from the line it's on in the conversations
+file) and the offset of its record in the conversation's data file. The
+checkpoint log records how many messages of each conversation have been
+indexed, so indexing can always pick up where it left off.
+"""
+
+import os
+import errno
+import fcntl
+import json
+import math
+import re
+import struct
+import threading
+import zlib
+
+import filesystem
+
+
+INDEX_DIR = os.path.join(filesystem.TAURUS_DIR, "index")
+SHARDS = 64
+
+# Posting: conversation number, record offset, times the word appears. Each
+# is preceded by the word itself, as a length byte and the bytes.
+POSTING = struct.Struct("!IQH")
+WORD_LENGTH = struct.Struct("!B")
+
+# Words longer than this aren't indexed.
+MAX_WORD = 64
+
+# How many characters of a message to show around the first match.
+SNIPPET = 60
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+# How many times as many lines as conversations the checkpoint log may have
+# before it's rewritten with one line each.
+CHECKPOINT_COMPACT = 4
+
+
+def words(text):
+    """
+    Return a dictionary of the distinct words in some text, lowercased and
+    UTF-8 encoded, to how many times each appears.
+    """
+    counts = {}
+    for word in WORD.findall(text.decode("utf-8", "replace").lower()):
+        word = word.encode("utf-8")
+        if len(word) <= MAX_WORD:
+            counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+def shard(word):
+    """
+    Return the number of the shard a word's postings go in.
+    """
+    return (zlib.crc32(word) & 0xffffffff) % SHARDS
+
+
+def snippet(message, query):
+    """
+    Return the part of a message around the first place one of the query
+    words appears, on one line, as unicode.
+    """
+    text = message.decode("utf-8", "replace").replace("\r", " ").replace("\n", " ")
+    lowered = text.lower()
+    found = [lowered.find(w.decode("utf-8")) for w in query]
+    found = [i for i in found if i >= 0]
+    start = max(0, min(found) - SNIPPET // 3) if found else 0
+    clip = text[start:start + SNIPPET]
+    if start > 0:
+        clip = "..." + clip
+    if start + SNIPPET < len(text):
+        clip += "..."
+    return clip
+
+
+class LineLog(object):
+    """
+    A file of lines which is only appended to (or replaced whole), read a
+    bit at a time: each read returns just the complete lines added since
+    the last one.
+    """
+    def __init__(self, path):
+        self.path = path
+        # How far the file has been read, and which file it was.
+        self.position = 0
+        self.inode = None
+
+    def read(self):
+        """
+        Return a list of the complete lines added since the last read, and
+        whether the file was replaced since then (in which case the list is
+        every line in it, and what was read before should be forgotten).
+        """
+        try:
+            f = open(self.path, "r")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return [], False
+            raise
+        with f:
+            st = os.fstat(f.fileno())
+            replaced = st.st_ino != self.inode or st.st_size < self.position
+            if replaced:
+                self.position = 0
+                self.inode = st.st_ino
+            f.seek(self.position)
+            data = f.read()
+        end = data.rfind("\n") + 1
+        self.position += end
+        return data[:end].splitlines(), replaced
+
+    def append(self, lines):
+        """
+        Append lines to the file. The caller holds the index lock, and has
+        read everything already there.
+        """
+        data = "".join(line + "\n" for line in lines)
+        with open(self.path, "a") as f:
+            # Finish off any line left incomplete by a crash.
+            if os.fstat(f.fileno()).st_size > self.position:
+                data = "\n" + data
+            f.write(data)
+            f.flush()
+            st = os.fstat(f.fileno())
+            self.position = st.st_size
+            self.inode = st.st_ino
+
+    def replace(self, lines):
+        """
+        Replace the whole file with the lines given. The caller holds the
+        index lock.
+        """
+        with open(self.path + ".tmp", "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        os.rename(self.path + ".tmp", self.path)
+        self.position = 0
+        self.inode = None
+
+
+class Index(object):
+    """
+    The full-text index in a directory. Shards which have been searched are
+    kept in memory, and only what's been appended since is read next time.
+    The conversation names and the checkpoint are kept in memory too, and
+    both are logs which are only appended to, so an update only reads what
+    other processes have added and writes lines for the conversations it
+    indexed.
+    """
+    def __init__(self, directory = INDEX_DIR):
+        self.directory = directory
+        self.names_log = LineLog(os.path.join(directory, "conversations"))
+        # One JSON [name, count] line per update; the last for each
+        # conversation wins.
+        self.checkpoint_log = LineLog(os.path.join(directory, "checkpoint.log"))
+        self.names = []
+        self.ids = {}
+        self.checkpoint = {}
+        self.checkpoint_lines = 0
+        # For each shard read so far: how far it's been read, and the
+        # postings, as word -> {(conversation, offset): count}.
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def shard_path(self, n):
+        return os.path.join(self.directory, "shard-{0:02d}".format(n))
+
+    def refresh(self):
+        """
+        Read any conversation names and checkpoint lines added since last
+        time. Needs self.lock.
+        """
+        lines, replaced = self.names_log.read()
+        if replaced:
+            self.names = []
+            self.ids = {}
+        for name in lines:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        lines, replaced = self.checkpoint_log.read()
+        if replaced:
+            self.checkpoint = {}
+            self.checkpoint_lines = 0
+        for line in lines:
+            try:
+                name, count = json.loads(line)
+            except ValueError:
+                # Part of a line left by a crash.
+                continue
+            self.checkpoint[name.encode("utf-8")] = count
+            self.checkpoint_lines += 1
+
+    def update(self, conversations = None):
+        """
+        Index any messages written since the checkpoint, in the named
+        conversations or all of them. Returns how many were indexed.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if conversations == None:
+            conversations = filesystem.conversations()
+        with self.lock:
+            with open(os.path.join(self.directory, "lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    return self._update(conversations)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def catch_up(self):
+        """
+        Index whatever the metadata cache says has been written since the
+        checkpoint, without opening any conversation which is up to date.
+        Returns how many messages were indexed.
+        """
+        info = filesystem.metadata.load()
+        with self.lock:
+            self.refresh()
+            behind = [name for name in info if info[name].count > self.checkpoint.get(name, 0)]
+        if not behind:
+            return 0
+        return self.update(behind)
+
+    def _update(self, conversations):
+        """
+        Do the work of update(), with the index locked.
+        """
+        self.refresh()
+        old = os.path.join(self.directory, "checkpoint")
+        if not self.checkpoint and os.path.exists(old):
+            # An index from before the checkpoint was a log.
+            with open(old, "r") as f:
+                done = json.load(f)
+            self.checkpoint_log.append(json.dumps([name, count]) for name, count in done.items())
+            os.remove(old)
+            self.refresh()
+        new_names = []
+        chunks = {}
+        done_lines = []
+        indexed = 0
+        for name in conversations:
+            conversation = filesystem.conversation_store(name)
+            length = len(conversation)
+            done = self.checkpoint.get(name, 0)
+            if done >= length:
+                conversation.close()
+                continue
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+                new_names.append(name)
+            for n in range(done, length):
+                offset = conversation.entry(n)[1]
+                message = conversation.read(offset)[2]
+                for word, count in words(message).items():
+                    posting = WORD_LENGTH.pack(len(word)) + word + POSTING.pack(self.ids[name], offset, min(count, 0xffff))
+                    chunks.setdefault(shard(word), []).append(posting)
+            conversation.close()
+            self.checkpoint[name] = length
+            done_lines.append(json.dumps([name, length]))
+            indexed += length - done
+        if not indexed:
+            return 0
+        # Names and postings go in before the checkpoint, so if we're
+        # interrupted, the worst that happens is some messages are indexed
+        # twice, which searching ignores.
+        if new_names:
+            self.names_log.append(new_names)
+        for n, postings in chunks.items():
+            with open(self.shard_path(n), "ab") as f:
+                f.write("".join(postings))
+        self.checkpoint_log.append(done_lines)
+        self.checkpoint_lines += len(done_lines)
+        if self.checkpoint_lines > CHECKPOINT_COMPACT * len(self.checkpoint) + 64:
+            self.checkpoint_log.replace(json.dumps([name, count]) for name, count in self.checkpoint.items())
+            self.checkpoint_lines = len(self.checkpoint)
+            self.checkpoint_log.read()
+        return indexed
+
+    def postings(self, word):
+        """
+        Return a dictionary of (conversation, offset) pairs to how many times
+        the word appears in that message. Needs self.lock.
+        """
+        n = shard(word)
+        position, table = self.shards.get(n, (0, {}))
+        path = self.shard_path(n)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(position)
+                data = f.read()
+            i = 0
+            # Stop at anything incomplete; it'll be finished next time.
+            while i < len(data):
+                length = ord(data[i])
+                end = i + 1 + length + POSTING.size
+                if end > len(data):
+                    break
+                conversation, offset, count = POSTING.unpack_from(data, i + 1 + length)
+                table.setdefault(data[i+1:i+1+length], {})[(conversation, offset)] = count
+                i = end
+            position += i
+        self.shards[n] = (position, table)
+        return table.get(word, {})
+
+    def search(self, query, limit = 20):
+        """
+        Find the messages containing every word in the query, and return
+        the best limit of them, best first, as a list of (score, conversation
+        name, (time, sender, message)) tuples. Messages score more for
+        containing the query words more often, and more still for rarer
+        words.
+        """
+        query = list(words(query))
+        if not query:
+            return []
+        with self.lock:
+            self.refresh()
+            total = max(1, sum(self.checkpoint.values()))
+            scores = None
+            for word in query:
+                found = self.postings(word)
+                weight = math.log(1.0 + float(total) / max(1, len(found)))
+                if scores == None:
+                    scores = dict((message, count * weight) for message, count in found.items())
+                else:
+                    scores = dict((message, score + found[message] * weight) for message, score in scores.items() if message in found)
+                if not scores:
+                    return []
+            names = list(self.names)
+        # Within a conversation, later records are newer, so they win ties.
+        best = sorted(scores.items(), key=lambda item: (item[1], item[0][1]), reverse=True)[:limit]
+        results = []
+        conversations = {}
+        for (c, offset), score in best:
+            name = names[c]
+            if name not in conversations:
+                conversations[name] = filesystem.conversation_store(name)
+            results.append((score, name, conversations[name].read(offset)))
+        for conversation in conversations.values():
+            conversation.close()
+        return results
+
+
+# The Index update() uses, made the first time it's needed and kept so
+# that each update only reads what's changed since the last.
+_index = [None]
+
+def update(conversations = None):
+    """
+    Bring the index in the default directory up to date with the named
+    conversations, or all of them. Returns how many messages were indexed.
+    """
+    if _index[0] == None:
+        _index[0] = Index()
+    return _index[0].update(conversations)
+
+
+def run_tests():
+    """
+    Tests for indexing and searching, with the messages and the index in a
+    temporary directory.
+    """
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="taurus-search-")
+    saved = filesystem.MESSAGE_DIR, filesystem._dirs_checked[0]
+    # Point the conversations at the temporary directory too.
+    filesystem.MESSAGE_DIR = directory
+    filesystem._dirs_checked[0] = True
+    try:
+        print("-- Testing indexing. --")
+        alice = filesystem.conversation_store("alice")
+        alice.append_many([(1.0, "alice", "Pizza tonight?"), (2.0, "alice", "no pizza"), (3.0, "alice", "hello world"), (5.0, "alice", "hello there")])
+        bob = filesystem.conversation_store("bob")
+        bob.append_many([(4.0, "bob", "pizza pizza pizza party")])
+        index = Index(os.path.join(directory, "index"))
+        assert index.update() == 5
+        print("Every message was indexed.")
+        assert index.update() == 0
+        print("Nothing is indexed twice.")
+
+        print("-- Testing searching. --")
+        hits = index.search("pizza")
+        assert [message for score, name, (t, sender, message) in hits][0] == "pizza pizza pizza party"
+        assert len(hits) == 3
+        print("Every message with the word is found, most uses first.")
+        hits = index.search("PIZZA tonight")
+        assert [(name, message) for score, name, (t, sender, message) in hits] == [("alice", "Pizza tonight?")]
+        print("Only messages with every word are found, whatever the case.")
+        hits = index.search("hello")
+        assert [message for score, name, (t, sender, message) in hits] == ["hello there", "hello world"]
+        print("Equal scores put the later message in a conversation first.")
+        assert index.search("absent") == [] and index.search("") == []
+        print("Searching for nothing or a missing word finds nothing.")
+        assert index.search("pizza", 1) == index.search("pizza")[:1]
+        print("The limit keeps the best hits.")
+        assert "tonight" in snippet("Pizza tonight?", ["tonight"])
+        print("The snippet includes the match.")
+
+        print("-- Testing incremental updates. --")
+        alice.append("alice", "late pizza", 6.0)
+        assert len(index.search("late")) == 0
+        assert Index(index.directory).update(["alice"]) == 1
+        hits = index.search("late pizza")
+        assert [message for score, name, (t, sender, message) in hits] == ["late pizza"]
+        print("New messages are found after indexing, without reading it all again.")
+        word = "partial"
+        posting = WORD_LENGTH.pack(len(word)) + word + POSTING.pack(0, 0, 1)
+        with open(index.shard_path(shard(word)), "ab") as f:
+            f.write(posting[:-3])
+        assert index.postings(word) == {}
+        with open(index.shard_path(shard(word)), "ab") as f:
+            f.write(posting[-3:])
+        assert index.postings(word) == {(0, 0): 1}
+        print("A partly-written posting is read once it's finished.")
+        for i in range(CHECKPOINT_COMPACT * 2 + 70):
+            alice.append("alice", "again", 10.0 + i)
+            assert index.update(["alice"]) == 1
+        with open(os.path.join(index.directory, "checkpoint.log")) as f:
+            assert len(f.readlines()) <= CHECKPOINT_COMPACT * 2 + 64
+        assert Index(index.directory).update() == 0
+        print("The checkpoint log is compacted without losing anything.")
+
+        print("-- Testing catching up. --")
+        saved_metadata = filesystem.metadata
+        filesystem.metadata = filesystem.MetadataCache(os.path.join(index.directory, "meta"))
+        try:
+            index = Index(index.directory)
+            assert index.catch_up() == 0
+            bob.append("bob", "pizza again", 100.0)
+            assert index.catch_up() == 0
+            print("Only conversations the metadata says are ahead are read.")
+            filesystem.metadata.written("bob", bob)
+            assert index.catch_up() == 1
+            assert len(index.search("again")) > 1
+            print("Conversations which are ahead are indexed.")
+        finally:
+            filesystem.metadata = saved_metadata
+        alice.close()
+        bob.close()
+    finally:
+        filesystem.MESSAGE_DIR, filesystem._dirs_checked[0] = saved
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="The Taurus full-text search index.")
+    parser.add_argument("-t", "--test", action="store_true", help="Run tests and exit.")
+    if parser.parse_args().test:
+        run_tests()
+    else:
+        parser.print_help()
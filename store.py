@@ -0,0 +1,360 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
+(See accompanying LICENSE file for details.)
+
+The on-disk format for conversations. Each conversation is two files:
+
+    <name>.msgs, the messages themselves, as records of a fixed-size header
+        (time, sender length, message length) followed by the sender and
+        message bytes, appended one after another;
+
+    <name>.idx, an index with one fixed-size (time, offset) entry for each
+        record in the .msgs file, in the same order.
+
+A record is always written before its index entry, so everything the index
+points to is complete. Readers only go by the index, and don't need a lock.
+"""
+
+import os
+import fcntl
+import struct
+import time
+
+
+DATA_SUFFIX = ".msgs"
+INDEX_SUFFIX = ".idx"
+
+# Record header: time, sender length, message length.
+RECORD = struct.Struct("!dHI")
+# Index entry: time, offset of the record in the data file.
+ENTRY = struct.Struct("!dQ")
+
+
+def format_record(record):
+    """
+    Format a (time, sender, message) record as a line of text, the way
+    conversations have always been displayed.
+    """
+    t, sender, message = record
+    return "[{time}] {sender}: {message}\n".format(time=time.strftime("%c", time.localtime(t)), sender=sender, message=message)
+
+
+class ConversationStore(object):
+    """
+    One conversation's messages, stored at the given path (without suffix).
+    Appending is constant time, finding the first message after a given time
+    is logarithmic, and messages can be read in either direction.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data_path = path + DATA_SUFFIX
+        self.index_path = path + INDEX_SUFFIX
+        self.data = None
+        self.index = None
+        # After an append: how many messages there were then, and the time
+        # of the last, so they can be known without opening the files.
+        self.appended = None
+
+    def _open(self):
+        """
+        Open the files for reading, if they aren't already. Returns False if
+        the conversation doesn't exist yet.
+        """
+        if self.index == None:
+            if not os.path.exists(self.index_path):
+                return False
+            self.data = open(self.data_path, "rb")
+            self.index = open(self.index_path, "rb")
+        return True
+
+    def close(self):
+        """
+        Close any files held open for reading.
+        """
+        if self.index != None:
+            self.data.close()
+            self.index.close()
+            self.data = None
+            self.index = None
+
+    def append(self, sender, message, t = None):
+        """
+        Append a message to the conversation, stamped with the given time
+        (or now). Returns the record's offset in the data file.
+        """
+        return self.append_many([(t, sender, message)])[0]
+
+    def append_many(self, records, files = None, sync = False):
+        """
+        Append a list of (time, sender, message) records to the conversation
+        under a single lock and write, stamping any with no time as now.
+        files can be a (data, index) pair from open_append(), to save opening
+        them again; otherwise they're opened and closed here. With sync, the
+        writes are also fsynced before returning. Returns a list of the
+        records' offsets in the data file.
+        """
+        if files == None:
+            data, index = self.open_append()
+            try:
+                return self.append_many(records, (data, index), sync)
+            finally:
+                data.close()
+                index.close()
+        data, index = files
+        fcntl.flock(data, fcntl.LOCK_EX)
+        try:
+            offsets = self._write(data, index, records)
+            if sync:
+                os.fsync(data.fileno())
+                os.fsync(index.fileno())
+        finally:
+            fcntl.flock(data, fcntl.LOCK_UN)
+        return offsets
+
+    def open_append(self):
+        """
+        Open the data and index files for appending, and return them as a
+        (data, index) pair for append_many(). The caller closes them.
+        """
+        data = open(self.data_path, "a+b")
+        index = open(self.index_path, "a+b")
+        return data, index
+
+    def _write(self, data, index, records):
+        """
+        Write records to open, locked data and index files. Returns a list of
+        the records' offsets.
+        """
+        self._repair(data, index)
+        data.seek(0, os.SEEK_END)
+        offset = data.tell()
+        chunks = []
+        entries = []
+        offsets = []
+        t = None
+        for t, sender, message in records:
+            if t == None:
+                t = time.time()
+            chunks.append(RECORD.pack(t, len(sender), len(message)))
+            chunks.append(sender)
+            chunks.append(message)
+            entries.append(ENTRY.pack(t, offset))
+            offsets.append(offset)
+            offset += RECORD.size + len(sender) + len(message)
+        data.write("".join(chunks))
+        data.flush()
+        index.write("".join(entries))
+        index.flush()
+        self.appended = (index.tell() // ENTRY.size, t)
+        return offsets
+
+    def _repair(self, data, index):
+        """
+        Index any records at the end of the data file which have no index
+        entry, which happens if a writer dies between the two writes, and cut
+        off any partially-written record or entry. Needs the write lock.
+        """
+        index.seek(0, os.SEEK_END)
+        index_size = index.tell()
+        data.seek(0, os.SEEK_END)
+        data_size = data.tell()
+        if index_size % ENTRY.size:
+            index_size -= index_size % ENTRY.size
+            index.truncate(index_size)
+        end = 0
+        if index_size:
+            index.seek(index_size - ENTRY.size)
+            t, end = ENTRY.unpack(index.read(ENTRY.size))
+            data.seek(end)
+            t, sender_length, message_length = RECORD.unpack(data.read(RECORD.size))
+            end += RECORD.size + sender_length + message_length
+        if end == data_size:
+            return
+        data.seek(end)
+        entries = []
+        while end + RECORD.size <= data_size:
+            t, sender_length, message_length = RECORD.unpack(data.read(RECORD.size))
+            length = RECORD.size + sender_length + message_length
+            if end + length > data_size:
+                break
+            entries.append(ENTRY.pack(t, end))
+            data.seek(length - RECORD.size, os.SEEK_CUR)
+            end += length
+        index.seek(0, os.SEEK_END)
+        index.write("".join(entries))
+        index.flush()
+        data.truncate(end)
+
+    def __len__(self):
+        """
+        The number of messages in the conversation.
+        """
+        if not self._open():
+            return 0
+        return os.fstat(self.index.fileno()).st_size // ENTRY.size
+
+    def entry(self, n):
+        """
+        Return the (time, offset) index entry of the nth message.
+        """
+        self.index.seek(n * ENTRY.size)
+        return ENTRY.unpack(self.index.read(ENTRY.size))
+
+    def read(self, offset):
+        """
+        Return the (time, sender, message) record at the given offset.
+        """
+        self._open()
+        self.data.seek(offset)
+        t, sender_length, message_length = RECORD.unpack(self.data.read(RECORD.size))
+        body = self.data.read(sender_length + message_length)
+        return t, body[:sender_length], body[sender_length:]
+
+    def __getitem__(self, n):
+        """
+        Return the nth message as a (time, sender, message) record. Negative
+        numbers count from the end.
+        """
+        length = len(self)
+        if n < 0:
+            n += length
+        if not 0 <= n < length:
+            raise IndexError("No message {0} in {1}.".format(n, self.path))
+        return self.read(self.entry(n)[1])
+
+    def records(self, start = 0, stop = None):
+        """
+        Yield the messages from number start up to (not including) stop, or
+        to the end, oldest first.
+        """
+        if stop == None:
+            stop = len(self)
+        n = start
+        while n < stop:
+            yield self.read(self.entry(n)[1])
+            n += 1
+
+    def __iter__(self):
+        return self.records()
+
+    def __reversed__(self):
+        """
+        Yield the messages newest first.
+        """
+        n = len(self)
+        while n > 0:
+            n -= 1
+            yield self.read(self.entry(n)[1])
+
+    def seek_time(self, t):
+        """
+        Return the number of the first message stamped at or after time t
+        (or the number of messages, if there are none), by binary search on
+        the index.
+        """
+        low = 0
+        high = len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def since(self, t):
+        """
+        Yield the messages stamped at or after time t, oldest first.
+        """
+        return self.records(self.seek_time(t))
+
+    def last(self, count):
+        """
+        Return a list of the last count messages, oldest first.
+        """
+        length = len(self)
+        return list(self.records(max(0, length - count), length))
+
+    def export(self, f):
+        """
+        Write the whole conversation to the file object f as text.
+        """
+        for record in self:
+            f.write(format_record(record))
+
+
+def run_tests():
+    """
+    Tests for appending, reading and repairing conversations, in a temporary
+    directory.
+    """
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="taurus-store-")
+    try:
+        print("-- Testing appending and reading. --")
+        conversation = ConversationStore(os.path.join(directory, "test"))
+        assert len(conversation) == 0
+        print("A new conversation is empty.")
+        records = [(1.0, "alice", "one"), (2.0, "bob", "two"), (3.0, "alice", "three\nlines")]
+        offsets = conversation.append_many(records)
+        assert len(conversation) == 3
+        assert list(conversation) == records
+        print("Appended records read back the same.")
+        assert [conversation.read(offset) for offset in offsets] == records
+        assert conversation[-1] == records[-1]
+        print("Records can be read by offset and by (negative) number.")
+        assert conversation.appended == (3, 3.0)
+        print("The count and time after appending are kept.")
+        assert list(reversed(conversation)) == records[::-1]
+        print("Reading in reverse gives the records newest first.")
+        assert conversation.seek_time(2.0) == 1
+        assert conversation.seek_time(2.5) == 2
+        assert conversation.seek_time(0) == 0
+        assert conversation.seek_time(4.0) == 3
+        assert list(conversation.since(2.5)) == records[2:]
+        assert conversation.last(2) == records[1:]
+        print("Seeking by time finds the first record at or after it.")
+        conversation.close()
+
+        print("-- Testing repair. --")
+        with open(conversation.data_path, "ab") as f:
+            f.write(RECORD.pack(4.0, 5, 4) + "carolfour")
+        conversation.append("dave", "five", 5.0)
+        assert len(conversation) == 5
+        assert conversation[3] == (4.0, "carol", "four")
+        assert conversation[4] == (5.0, "dave", "five")
+        print("A record with no index entry gets indexed.")
+        conversation.close()
+        with open(conversation.data_path, "ab") as f:
+            f.write(RECORD.pack(6.0, 3, 100) + "eve")
+        conversation.append("frank", "seven", 7.0)
+        assert len(conversation) == 6
+        assert conversation[5] == (7.0, "frank", "seven")
+        print("A partial record is cut off.")
+        conversation.close()
+        with open(conversation.index_path, "ab") as f:
+            f.write(ENTRY.pack(8.0, 0)[:5])
+        conversation.append("grace", "nine", 9.0)
+        assert len(conversation) == 7
+        assert list(conversation)[-2:] == [(7.0, "frank", "seven"), (9.0, "grace", "nine")]
+        print("A partial index entry is cut off.")
+        assert os.path.getsize(conversation.index_path) == 7 * ENTRY.size
+        print("The index is the right size afterwards.")
+        conversation.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="The on-disk format for Taurus conversations.")
+    parser.add_argument("-t", "--test", action="store_true", help="Run tests and exit.")
+    if parser.parse_args().test:
+        run_tests()
+    else:
+        parser.print_help()
@@ -13,9 +13,13 @@ information about valid users and functions for finding them.
 import os
 import fcntl
 import csv
+import socket
+import threading
+import time
 
 import ciphersaber2
 import filesystem
+import trie
 
 
 VERSION = "0.2"
@@ -24,10 +28,20 @@ PORT = 6283
 KEY = "password"
 USERNAME = "relsqui"
 
+# Seconds a looked-up host address is trusted before looking it up again.
+RESOLVE_TTL = 300
+
+# The user table file, and the fewest seconds between checks for changes.
+USERS_FILE = os.path.join(filesystem.TAURUS_DIR, "users.csv")
+RELOAD_INTERVAL = 1
+
 MAX_TNM = 1024
 MAX_HEADERS = 90
 MAX_MESSAGE = MAX_TNM - MAX_HEADERS
 
+# The headers every message has, in order.
+HEADERS = ("version", "from", "to")
+
 
 class TauNetError(Exception):
     pass
@@ -44,14 +58,19 @@ class TauNetMessage(object):
 
     Either one will cause all the appropriate fields to be populated.
     """
+    # There can be a lot of these around at once (in the daemon's queues),
+    # so they don't each get an attribute dictionary.
+    __slots__ = ("ciphertext", "version", "sender", "recipient", "message", "pending")
+
     def __init__(self):
         self.ciphertext = None
-        self.cleartext = None
         self.version = None
         # The header is called "from" but that's a python keyword.
         self.sender = None
         self.recipient = None
         self.message = None
+        # Decryption state between incoming_headers and incoming_message.
+        self.pending = None
 
     def test(self):
         """
@@ -69,11 +88,72 @@ class TauNetMessage(object):
 
         Returns the populated TauNetMessage.
         """
+        self.incoming_headers(ciphertext)
+        self.incoming_message()
+        return self
+
+    def incoming_headers(self, ciphertext, timings = None):
+        """
+        Read in received ciphertext, but only decrypt enough of it to parse
+        the headers (normally MAX_HEADERS bytes), and populate version,
+        sender, and recipient. A message can be turned away on its headers
+        this way without decrypting the rest; call incoming_message() to
+        finish reading it. If a timings dictionary is given, the seconds
+        spent are added to its "decrypt" and "parse" entries.
+
+        Returns the TauNetMessage.
+        """
         self.ciphertext = ciphertext
-        self.cleartext = ciphersaber2.decrypt(ciphertext, KEY)
-        self.parse_headers()
+        started = time.time()
+        decryptor = ciphersaber2.Decryptor(KEY)
+        decrypted = min(ciphersaber2.IV_LENGTH + MAX_HEADERS, len(ciphertext))
+        cleartext = decryptor.update_buffer(ciphertext[:decrypted])
+        self.pending = (decryptor, cleartext, decrypted, None)
+        parsing = time.time()
+        try:
+            offset = self.parse_headers(cleartext, decrypted >= len(ciphertext))
+            if offset == None:
+                # Unusually long headers; decrypt the rest to find their end.
+                # (This is rare enough that it's all counted as parsing.)
+                cleartext.extend(decryptor.update_buffer(ciphertext[decrypted:]))
+                decrypted = len(ciphertext)
+                self.pending = (decryptor, cleartext, decrypted, None)
+                offset = self.parse_headers(cleartext)
+        finally:
+            if timings != None:
+                timings["decrypt"] = timings.get("decrypt", 0) + parsing - started
+                timings["parse"] = timings.get("parse", 0) + time.time() - parsing
+        self.message = None
+        self.pending = (decryptor, cleartext, decrypted, offset)
+        return self
+
+    def incoming_message(self, timings = None):
+        """
+        Decrypt the rest of a message whose headers were read by
+        incoming_headers(), and populate the message attribute. If a timings
+        dictionary is given, the seconds spent are added to its "decrypt"
+        entry.
+
+        Returns the TauNetMessage.
+        """
+        started = time.time()
+        decryptor, cleartext, decrypted, offset = self.pending
+        self.pending = None
+        cleartext.extend(decryptor.update_buffer(self.ciphertext[decrypted:]))
+        self.message = memoryview(cleartext)[offset:].tobytes()
+        if timings != None:
+            timings["decrypt"] = timings.get("decrypt", 0) + time.time() - started
         return self
 
+    def undecrypted(self):
+        """
+        Return how many bytes of ciphertext incoming_headers() left for
+        incoming_message() to decrypt, including when it raised TauNetError.
+        """
+        if self.pending == None:
+            return 0
+        return len(self.ciphertext) - self.pending[2]
+
     def outgoing(self, recipient, message):
         """
         Build a properly-formatted TauNetMessage with the given payload
@@ -85,49 +165,73 @@ class TauNetMessage(object):
         self.sender = USERNAME
         self.message = message[:MAX_MESSAGE]
         self.version = VERSION
-        self.cleartext = self.build_headers() + message
-        self.ciphertext = ciphersaber2.encrypt(self.cleartext, KEY)
+        # The cleartext is built right after the IV, and encrypted in place.
+        buf = bytearray(ciphersaber2.random_iv())
+        self.write_headers(buf)
+        buf.extend(self.message)
+        self.ciphertext = bytes(ciphersaber2.context(KEY).encrypt_buffer(buf))
         return self
 
+    def write_headers(self, buf):
+        """
+        Use the object attributes to build the headers, and append them to
+        the bytearray buf, ready for the message payload to follow. Returns
+        buf.
+        """
+        for header, value in zip(HEADERS, (self.version, self.sender, self.recipient)):
+            buf.extend(header)
+            buf.extend(": ")
+            buf.extend(value)
+            buf.extend("\r\n")
+        buf.extend("\r\n")
+        return buf
+
     def build_headers(self):
         """
         Use the object attributes to build a header string, which can then
         be prepended to the message payload to get a cleartext message ready
         for encryption.
         """
-        headers = []
-        headers.append("version: " + self.version)
-        headers.append("from: " + self.sender)
-        headers.append("to: " + self.recipient)
-        headers.append("\r\n")
-        return "\r\n".join(headers)
+        return bytes(self.write_headers(bytearray()))
 
-    def parse_headers(self):
+    def parse_headers(self, cleartext, complete = True):
         """
-        Parse the TauNet headers out of the cleartext attribute and populate
-        the other specific attributes: version, sender, recipient, and message.
+        Parse the TauNet headers out of the given cleartext (a string or
+        bytearray) and populate the other specific attributes: version,
+        sender, recipient, and message. The cleartext is read in one pass,
+        and only the fields themselves are copied out of it. Returns the
+        offset of the message payload.
+
+        If complete is false, the cleartext may be just the start of the
+        message. Anything already wrong with it still raises TauNetError,
+        but if it ends before the headers do, None is returned.
         """
-        cleartext = self.cleartext
-        headers = {}
-        try:
-            headers["version"], cleartext = cleartext.split("\r\n", 1)
-            headers["from"], cleartext = cleartext.split("\r\n", 1)
-            headers["to"], cleartext = cleartext.split("\r\n", 1)
-        except ValueError:
-            raise TauNetError("Wrong header count or bad separators.")
-        for header in headers:
-            if not headers[header].startswith(header + ": "):
-                raise TauNetError("Header format error: {0}".format(headers[header]))
-            headers[header] = headers[header][len(header)+2:]
-            if not headers[header]:
+        start = 0
+        values = []
+        for header in HEADERS:
+            prefix = header + ": "
+            end = cleartext.find("\r\n", start)
+            if end < 0:
+                if complete:
+                    raise TauNetError("Wrong header count or bad separators.")
+                # Check as much of the line as there is so far.
+                line = str(cleartext[start:start+len(prefix)])
+                if not prefix.startswith(line):
+                    raise TauNetError("Header format error: {0}".format(line))
+                return None
+            if not cleartext.startswith(prefix, start, end):
+                raise TauNetError("Header format error: {0}".format(str(cleartext[start:end])))
+            if start + len(prefix) == end:
                 raise TauNetError("Empty '{0}' header.".format(header))
-        if not cleartext.startswith("\r\n"):
+            values.append(str(cleartext[start+len(prefix):end]))
+            start = end + 2
+        if not complete and len(cleartext) < start + 2:
+            return None
+        if not cleartext.startswith("\r\n", start):
             raise TauNetError("No blank line after headers.")
-        cleartext = cleartext[2:]
-        self.message = cleartext
-        self.version = headers["version"]
-        self.sender = headers["from"]
-        self.recipient = headers["to"]
+        self.version, self.sender, self.recipient = values
+        self.message = memoryview(cleartext)[start+2:].tobytes()
+        return start + 2
 
 
 class TauNetUser(object):
@@ -139,52 +243,299 @@ class TauNetUser(object):
         self.host = host
         self.port = port
         self.is_on = False
+        # When the node last accepted a connection from us.
+        self.last_seen = 0
+        # The last address the host resolved to, and when.
+        self.address = None
+        self.resolved = 0
+
+
+class UserIndex(object):
+    """
+    One loaded version of the user table, indexed in the ways it gets
+    looked up. UserTable replaces the whole thing when the file changes,
+    so anyone holding one always sees a consistent set of users.
+    """
+    def __init__(self, all_users):
+        self.all_users = sorted(all_users, key=lambda u: u.name.lower())
+        self.users_by_host = {}
+        self.users_by_name = {}
+        self.users_by_address = {}
+        self.names = trie.Trie()
+        for tnu in self.all_users:
+            self.names.add(tnu.name)
+            self.users_by_host[tnu.host] = tnu
+            self.users_by_name[tnu.name] = tnu
+            if tnu.address:
+                self.users_by_address.setdefault(tnu.address, []).append(tnu)
 
 
 class UserTable(object):
     """
     The list of valid users whom messages can be sent to and received from.
+    The table is read from the users.csv file the first time it's used, and
+    read again whenever the file has changed (checking at most every
+    RELOAD_INTERVAL seconds). If the file can't be read, or has a line
+    which isn't username,host,port, the error is logged and the last good
+    version is kept.
     """
     def __init__(self):
-        self.load_users()
+        self.index = UserIndex([])
+        self.loaded = False
+        self.signature = None
+        # The signature of the last version of the file which couldn't be
+        # read (None if it was missing), so it isn't tried again until it
+        # changes.
+        self.rejected = False
+        self.checked = 0
+        # Held while building or swapping in a new index, and while moving
+        # a user to a new address in it, so neither change is lost.
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def file_signature(self):
+        """
+        Return something which changes when the user table file does.
+        """
+        try:
+            st = os.stat(USERS_FILE)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def check(self):
+        """
+        Load the user table if it hasn't been yet, or reload it if the file
+        has changed since, unless it was checked less than RELOAD_INTERVAL
+        seconds ago. Returns the current UserIndex.
+        """
+        if not self.loaded:
+            self.load_users()
+        now = time.time()
+        if now - self.checked >= RELOAD_INTERVAL:
+            self.checked = now
+            if self.file_signature() != self.signature:
+                self.load_users()
+        return self.index
 
     def load_users(self):
         """
         Parse the user table file and populate lists of TauNetUser objects.
+        Users whose entries haven't changed keep the same TauNetUser, along
+        with its online status and resolved address.
         """
-        self.users_by_host = {}
-        self.users_by_name = {}
-        self.all_users = []
-        with open(os.path.join(filesystem.TAURUS_DIR, "users.csv"), "r") as f:
-            fcntl.flock(f, fcntl.LOCK_EX)
-            reader = csv.reader(f.readlines())
-            fcntl.flock(f, fcntl.LOCK_UN)
-        for user in reader:
-            tnu = TauNetUser(user[0], user[1], int(user[2]))
-            self.users_by_host[user[1]] = tnu
-            self.users_by_name[user[0]] = tnu
-            self.all_users.append(tnu)
+        with self.lock:
+            signature = self.file_signature()
+            self.checked = time.time()
+            self.loaded = True
+            if signature == self.rejected:
+                return
+            try:
+                with open(USERS_FILE, "r") as f:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                    reader = csv.reader(f.readlines())
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                old = self.index.users_by_name
+                all_users = []
+                for n, user in enumerate(reader, 1):
+                    if not user:
+                        continue
+                    if len(user) != 3:
+                        raise ValueError("line {n} should be username,host,port".format(n=n))
+                    tnu = old.get(user[0])
+                    if tnu == None or (tnu.host, tnu.port) != (user[1], int(user[2])):
+                        tnu = TauNetUser(user[0], user[1], int(user[2]))
+                    all_users.append(tnu)
+                index = UserIndex(all_users)
+            except (IOError, ValueError) as e:
+                # Keep using the last good version until the file is fixed.
+                self.rejected = signature
+                filesystem.get_logger("taunet").error("Can't read user table {filename}, keeping the old one: {error}".format(filename=USERS_FILE, error=e))
+                return
+            # Swap in the new version all at once.
+            self.index = index
+            self.signature = signature
 
     def all(self):
         """
-        Fetch the complete user list. This is a function just for consistency
-        with the other two user-fetching functions.
+        Fetch the complete user list, sorted by name. This is a function just
+        for consistency with the other two user-fetching functions.
         """
-        return sorted(self.all_users, key=lambda u: u.name.lower())
+        return list(self.check().all_users)
 
     def by_name(self, name):
         """
         Check the user table for a TauNetUser with the name given. If found,
         return it. Otherwise, return None.
         """
-        return self.users_by_name.get(name)
+        return self.check().users_by_name.get(name)
+
+    def complete(self, prefix = ""):
+        """
+        Return a sorted list of the usernames which start with the prefix
+        given.
+        """
+        return self.check().names.complete(prefix)
 
     def by_host(self, host):
         """
         Check the user table for a TauNetUser with the host given. If found,
         return it. Otherwise, return None.
         """
-        return self.users_by_host.get(host)
+        return self.check().users_by_host.get(host)
 
+    def by_address(self, address):
+        """
+        Check the user table for TauNetUsers whose hosts were last seen to
+        resolve to the IP address given, and return a list of them. This
+        doesn't look anything up; see resolve().
+        """
+        return self.check().users_by_address.get(address, [])
+
+    def resolve(self, tnu, max_age = None):
+        """
+        Return the IP address of a TauNetUser's host. The last result is
+        reused if it's newer than max_age seconds (default RESOLVE_TTL);
+        otherwise the host is looked up again and the cache updated.
+        Raises socket.error if the lookup fails.
+        """
+        if max_age == None:
+            max_age = RESOLVE_TTL
+        if tnu.address and time.time() - tnu.resolved < max_age:
+            return tnu.address
+        address = socket.gethostbyname(tnu.host)
+        with self.lock:
+            index = self.index
+            users_by_address = index.users_by_address
+            if tnu.address and tnu in users_by_address.get(tnu.address, []):
+                users_by_address[tnu.address].remove(tnu)
+            # A user dropped from the table since isn't added back.
+            if index.users_by_name.get(tnu.name) is tnu:
+                users_by_address.setdefault(address, []).append(tnu)
+            tnu.address = address
+            tnu.resolved = time.time()
+        return address
+
+    def refresh(self, interval):
+        """
+        Resolve every user's host which is due to expire in the next interval,
+        so that resolve() rarely has to wait for a lookup. Failed lookups
+        keep their last known address.
+        """
+        for tnu in self.all():
+            try:
+                self.resolve(tnu, RESOLVE_TTL - interval)
+            except socket.error:
+                pass
 
+    def start_refresh(self, interval = None):
+        """
+        Keep the cached host addresses fresh from a background thread,
+        refreshing every interval seconds (by default, a third of
+        RESOLVE_TTL). Does nothing if this process already has one running.
+        """
+        if interval == None:
+            interval = RESOLVE_TTL / 3
+        if self.refresher and self.refresher.is_alive():
+            return
+        def run():
+            while True:
+                self.refresh(interval)
+                time.sleep(interval)
+        self.refresher = threading.Thread(target=run, name="resolver")
+        self.refresher.daemon = True
+        self.refresher.start()
+
+
+# Nothing is read until the first lookup.
 users = UserTable()
+
+
+def run_tests():
+    """
+    Tests for building, encrypting and parsing messages, and for turning
+    bad ones away before their payload is decrypted.
+    """
+    def encrypt(cleartext):
+        buf = bytearray(ciphersaber2.random_iv())
+        buf.extend(cleartext)
+        return bytes(ciphersaber2.context(KEY).encrypt_buffer(buf))
+
+    def rejected(parse):
+        try:
+            parse()
+        except TauNetError:
+            return True
+        return False
+
+    print("-- Testing building messages. --")
+    tnm = TauNetMessage().outgoing("alice", "hello")
+    assert tnm.build_headers() == "version: {0}\r\nfrom: {1}\r\nto: alice\r\n\r\n".format(VERSION, USERNAME)
+    assert len(tnm.ciphertext) == ciphersaber2.IV_LENGTH + len(tnm.build_headers()) + len("hello")
+    print("Headers come in order, followed by a blank line and the payload.")
+    received = TauNetMessage().incoming(tnm.ciphertext)
+    assert (received.version, received.sender, received.recipient, received.message) == (VERSION, USERNAME, "alice", "hello")
+    print("An outgoing message reads back the same.")
+    tnm = TauNetMessage().outgoing("alice", "x" * (MAX_TNM * 2))
+    assert tnm.message == "x" * MAX_MESSAGE
+    assert TauNetMessage().incoming(tnm.ciphertext).message == tnm.message
+    print("Payloads are cut to MAX_MESSAGE bytes.")
+    assert not hasattr(tnm, "__dict__")
+    print("Messages have no attribute dictionary.")
+
+    print("-- Testing parsing headers. --")
+    tnm = TauNetMessage()
+    headers = "version: 0.2\r\nfrom: bob\r\nto: alice\r\n\r\n"
+    for cleartext in (headers + "hi", bytearray(headers + "hi")):
+        assert tnm.parse_headers(cleartext) == len(headers)
+        assert (tnm.version, tnm.sender, tnm.recipient, tnm.message) == ("0.2", "bob", "alice", "hi")
+    print("Strings and bytearrays parse the same.")
+    for n in range(len(headers) + 1):
+        assert tnm.parse_headers(headers[:n], False) in (None, len(headers))
+    assert tnm.parse_headers(headers[:len(headers) - 1], False) == None
+    print("A truncated prefix of good headers isn't an error yet.")
+    assert rejected(lambda: tnm.parse_headers("versoin", False))
+    assert rejected(lambda: tnm.parse_headers("version: 0.2\r\nfrum", False))
+    print("A truncated prefix which has already gone wrong is rejected.")
+    assert rejected(lambda: tnm.parse_headers("version: 0.2\r\nfrom: bob\r\n"))
+    assert rejected(lambda: tnm.parse_headers("version: 0.2\r\nfrom: \r\nto: alice\r\n\r\n"))
+    assert rejected(lambda: tnm.parse_headers("to: alice\r\nfrom: bob\r\nversion: 0.2\r\n\r\n"))
+    print("Missing, empty and out-of-order headers are rejected.")
+    assert rejected(lambda: tnm.parse_headers("version: 0.2\r\nfrom: bob\r\nto: alice\r\nhi"))
+    assert rejected(lambda: tnm.parse_headers("version: 0.2\r\nfrom: bob\r\nto: alice\r\nhi", False))
+    print("Headers without a blank line after them are rejected.")
+
+    print("-- Testing decrypting incoming messages. --")
+    payload = "y" * 500
+    tnm = TauNetMessage().incoming_headers(encrypt(headers + payload))
+    assert (tnm.sender, tnm.recipient, tnm.message) == ("bob", "alice", None)
+    assert tnm.undecrypted() == len(headers) + len(payload) - MAX_HEADERS
+    tnm.incoming_message()
+    assert tnm.message == payload and tnm.undecrypted() == 0
+    print("Only the headers are decrypted until the payload is asked for.")
+    long_headers = "version: 0.2\r\nfrom: {0}\r\nto: alice\r\n\r\n".format("b" * MAX_HEADERS)
+    tnm = TauNetMessage().incoming(encrypt(long_headers + payload))
+    assert tnm.sender == "b" * MAX_HEADERS and tnm.message == payload
+    print("Headers longer than MAX_HEADERS are still read.")
+    tnm = TauNetMessage()
+    assert rejected(lambda: tnm.incoming_headers(encrypt("garbage\r\n" + payload)))
+    assert tnm.undecrypted() == len("garbage\r\n" + payload) - MAX_HEADERS
+    tnm = TauNetMessage()
+    assert rejected(lambda: tnm.incoming_headers(encrypt("version: 0.2\r\nfrom: bob\r\nto: alice\r\n" + payload)))
+    assert tnm.undecrypted() == len(headers) - 2 + len(payload) - MAX_HEADERS
+    print("Bad headers are rejected without decrypting the payload.")
+    tnm = TauNetMessage().incoming(encrypt(headers))
+    assert tnm.message == "" and tnm.undecrypted() == 0
+    assert TauNetMessage().test().ciphertext == ""
+    print("Empty payloads and test messages work.")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="The TauNet protocol: messages and the user table.")
+    parser.add_argument("-t", "--test", action="store_true", help="Run tests and exit.")
+    if parser.parse_args().test:
+        run_tests()
+    else:
+        parser.print_help()
@@ -8,15 +8,38 @@ Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
 import socket
 import sys
 import curses
+import collections
 import time
 
 import taunet
 import filesystem
+import outbox
+import store
+import search
+import trie
 
 
 # Set up logger.
 logger=filesystem.get_logger("taurus")
 
+# How many nodes to check at once when updating status, and to send to at
+# once when sending to several users.
+STATUS_WORKERS = 32
+SEND_WORKERS = 32
+# Nodes seen online less than this many seconds ago (by a status check or a
+# delivered message) are skipped when updating status. 0 checks everyone.
+STATUS_WINDOW = 0
+
+# Delivers queued messages in the background while the client is running.
+outbox_sender = outbox.Sender(lambda tnu, tnm: ship_tnm(tnu, tnm, queue=False))
+
+# The search index, which keeps what it's read in memory between searches.
+search_index = search.Index()
+
+# The names of the conversations listed so far, for completing as they're
+# typed. Conversations are never removed, so this only grows.
+conversation_names = trie.Trie()
+
 
 def safe_put(stdscr, string, loc):
     """
@@ -29,47 +52,95 @@ def safe_put(stdscr, string, loc):
     else:
         stdscr.addstr(loc[0], loc[1], string.encode("utf-8"))
 
-def ship_tnm(tnu, tnm):
+def ship_tnm(tnu, tnm, queue=True):
     """
-    Send a TauNetMessage over the network to its recipient.
+    Send a TauNetMessage over the network to its recipient. If that fails
+    and queue is true, the message goes in the outbox to be retried later.
+    Either way, the recipient's online status is updated to match.
     """
     user_string = "{user} ({host}:{port})".format(user=tnu.name, host=tnu.host, port=str(tnu.port))
     sender = socket.socket()
     sender.settimeout(1)
     try:
-        sender.connect((tnu.host, tnu.port))
-        sender.send(tnm.ciphertext)
+        sender.connect((taunet.users.resolve(tnu), tnu.port))
+        sender.sendall(tnm.ciphertext)
         sender.shutdown(socket.SHUT_RDWR)
     except (socket.error, socket.timeout) as e:
-        # Commented out to save it for the message queue later.
-        # print("Unable to reach {user}: {reason}".format(user=user_string, reason=str(e)))
+        tnu.is_on = False
         if tnm.ciphertext:
-            # Only log for real messages, not status checks
+            # Only log and queue real messages, not status checks
             logger.error("Failed to send a message to {user}: {reason}".format(user=user_string, reason=str(e)))
+            if queue:
+                outbox.enqueue(tnu.name, tnm)
         sender.close()
         return False
     else:
+        tnu.is_on = True
+        tnu.last_seen = time.time()
         if tnm.ciphertext:
             logger.info("Sent a message to {user}.".format(user=user_string))
             filesystem.write_message(tnu.name, tnm)
         sender.close()
         return True
 
-def is_online(tnu):
+def is_online(tnu, window=0):
     """
     Attempt to send an empty message, to see if a TauNet node is online.
+    If a window is given, a node which was seen online less than that many
+    seconds ago is assumed to still be online without checking.
     """
-    if ship_tnm(tnu, taunet.TauNetMessage().test()):
-        taunet.users.by_name(tnu.name).is_on = True
+    if window and tnu.is_on and time.time() - tnu.last_seen < window:
         return True
-    taunet.users.by_name(tnu.name).is_on = False
-    return False
+    return ship_tnm(tnu, taunet.TauNetMessage().test())
+
+def parse_recipients(text):
+    """
+    Turn a list of usernames separated by commas or spaces into a list of
+    TauNetUsers. "*" stands for everyone in the user table except us, and
+    the start of a name stands for the one user whose name starts that way.
+    Returns a tuple of the list of users and a list of any names which
+    aren't in the user table.
+    """
+    recipients = []
+    unknown = []
+    for name in text.replace(",", " ").split():
+        if name == "*":
+            found = [u for u in taunet.users.all() if u.name != taunet.USERNAME]
+        else:
+            tnu = taunet.users.by_name(name)
+            if tnu == None:
+                matches = taunet.users.complete(name)
+                if len(matches) == 1:
+                    tnu = taunet.users.by_name(matches[0])
+            found = [tnu] if tnu else []
+            if not found:
+                unknown.append(name)
+        recipients.extend(u for u in found if u not in recipients)
+    return recipients, unknown
+
+def ship_all(recipients, message):
+    """
+    Send the same message to each of a list of TauNetUsers, SEND_WORKERS at a
+    time, so that the whole lot takes about as long as the slowest one.
+    Undeliverable messages are queued, as by ship_tnm. Yields a
+    (TauNetUser, delivered) tuple for each recipient as it finishes.
+    """
+    # Only needed here, and slow to import, so it isn't done at startup.
+    from multiprocessing.pool import ThreadPool
+    def ship(tnu):
+        return tnu, ship_tnm(tnu, taunet.TauNetMessage().outgoing(tnu.name, message))
+    pool = ThreadPool(max(1, min(SEND_WORKERS, len(recipients))))
+    try:
+        for result in pool.imap_unordered(ship, recipients):
+            yield result
+    finally:
+        pool.close()
 
 def send_message(stdscr, username=None):
     """
-    Prompt for a user and message, generate a TauNetMessage, and send it.
-    The optional keyword argument is a username; if this is supplied,
-    the user won't be prompted for one.
+    Prompt for users and a message, generate a TauNetMessage for each
+    user, and send them. The optional keyword argument is a username; if
+    this is supplied, the user won't be prompted for any.
     """
     # Show the cursor and echo output.
     curses.curs_set(1)
@@ -77,36 +148,82 @@ def send_message(stdscr, username=None):
     stdscr.clear()
     stdscr.refresh()
     if username is None:
-        safe_put(stdscr, "Recipient username: ", (0, 0))
-        username = stdscr.getstr(0, 20)
+        prompt = "Recipient username(s), or * for everyone: "
+        safe_put(stdscr, prompt, (0, 0))
+        username = stdscr.getstr(0, len(prompt))
         stdscr.clear()
         stdscr.refresh()
-    tnu = taunet.users.by_name(username)
-    if tnu == None:
-        print("No such user. Known users: " + ", ".join(sorted([u.name for u in taunet.users.all()])))
-        return
-    if not is_online(tnu):
-        print("Couldn't connect to that user's host.")
+    recipients, unknown = parse_recipients(username)
+    if unknown or not recipients:
+        for name in unknown:
+            matches = taunet.users.complete(name)
+            if matches:
+                print("'{name}' could be any of: {matches}".format(name=name, matches=", ".join(matches)))
+            else:
+                print("No such user: {name}".format(name=name))
+        print("Known users: " + ", ".join(taunet.users.complete()))
         return
     safe_put(stdscr, "Message:", (0, 0))
     message = stdscr.getstr(0, 9)
     stdscr.clear()
     stdscr.refresh()
-    ship_tnm(tnu, taunet.TauNetMessage().outgoing(tnu.name, message))
+    if len(recipients) == 1:
+        if not ship_tnm(recipients[0], taunet.TauNetMessage().outgoing(recipients[0].name, message)):
+            print("Couldn't connect to that user's host; the message will be queued until it can be delivered.")
+        return
+    send_many(stdscr, recipients, message)
+
+def send_many(stdscr, recipients, message):
+    """
+    Send a message to several users at once, showing how each delivery went
+    as it finishes.
+    """
+    curses.curs_set(0)
+    curses.noecho()
+    safe_put(stdscr, "Sending to {n} users, please wait ...".format(n=len(recipients)), (2, 1))
+    stdscr.refresh()
+    row = 4
+    delivered = 0
+    for i, (user, ok) in enumerate(ship_all(recipients, message), 1):
+        if ok:
+            delivered += 1
+        # List as many as fit; the count below covers the rest.
+        if row < curses.LINES - 3:
+            safe_put(stdscr, "{name} {result}".format(name=user.name.ljust(30), result="delivered" if ok else "queued"), (row, 1))
+            row += 1
+        safe_put(stdscr, "({i}/{j})".format(i=i, j=len(recipients)), (2, 40))
+        stdscr.refresh()
+    safe_put(stdscr, "Delivered to {n} of {j}; the rest are queued. Hit any key to return to menu.".format(n=delivered, j=len(recipients)), (row + 1, 1))
+    stdscr.refresh()
+
+    # Wait for any key, then clear and return to menu.
+    stdscr.getch()
+    stdscr.clear()
+    stdscr.refresh()
 
 def update_status(stdscr):
     """
-    Update the online status of the users in the table.
+    Update the online status of the users in the table. All the nodes are
+    checked at once (up to STATUS_WORKERS), so this takes about as long as
+    the slowest one rather than all of them added together.
     """
+    # Only needed here, and slow to import, so it isn't done at startup.
+    from multiprocessing.pool import ThreadPool
     safe_put(stdscr, "Checking node status, please wait ...", (2, 1))
+    stdscr.refresh()
     users = taunet.users.all()
-    i = 0
     j = len(users)
-    for user in users:
-        i += 1
-        safe_put(stdscr, "({i}/{j}) {name}".format(i=i, j=j, name=user.name.ljust(30)), (2, 39))
-        is_online(user)
-        stdscr.refresh()
+    def check(user):
+        is_online(user, STATUS_WINDOW)
+        return user
+    pool = ThreadPool(max(1, min(STATUS_WORKERS, j)))
+    try:
+        # Show each result as it comes in, in whatever order that is.
+        for i, user in enumerate(pool.imap_unordered(check, users), 1):
+            safe_put(stdscr, "({i}/{j}) {name}".format(i=i, j=j, name=user.name.ljust(30)), (2, 39))
+            stdscr.refresh()
+    finally:
+        pool.close()
     stdscr.clear()
     stdscr.refresh()
 
@@ -129,73 +246,240 @@ def view_users(stdscr):
     stdscr.clear()
     stdscr.refresh()
 
-def list_messages(stdscr):
+def view_outbox(stdscr):
     """
-    List the messages available to be read and prompt to read one.
+    View the messages waiting in the outbox, and delivery statistics.
+    """
+    stdscr.clear()
+    safe_put(stdscr, "Queued messages. Hit any key to return to menu.", (2, 1))
+    average = outbox_sender.total_latency / outbox_sender.delivered if outbox_sender.delivered else 0
+    safe_put(stdscr, "Delivered from queue: {n} (average wait {avg:.0f}s, longest {max:.0f}s)".format(n=outbox_sender.delivered, avg=average, max=outbox_sender.max_latency), (4, 1))
+    row = 6
+    rows = outbox_sender.stats()
+    if not rows:
+        safe_put(stdscr, "The outbox is empty.", (row, 1))
+    for name, count, age, retry in rows:
+        safe_put(stdscr, "{name} {count} queued, oldest {age:.0f}s, next try in {retry:.0f}s".format(name=name.ljust(20), count=count, age=age, retry=retry), (row, 1))
+        row += 1
+    stdscr.refresh()
+
+    # Wait for any key, then clear and return to menu.
+    stdscr.getch()
+    stdscr.clear()
+    stdscr.refresh()
+
+def find_messages(stdscr):
+    """
+    Prompt for words to search for, and list the messages containing them,
+    best matches first.
     """
-    # Show the cursor and echo output.
     curses.curs_set(1)
     curses.echo()
-    conversations = filesystem.conversations()
     stdscr.clear()
-    row = 1
-    column = 1
-    for name in conversations:
-        safe_put(stdscr, name, (row, column))
+    prompt = "Search for: "
+    safe_put(stdscr, prompt, (0, 0))
+    query = stdscr.getstr(0, len(prompt))
+    curses.curs_set(0)
+    curses.noecho()
+    stdscr.clear()
+    safe_put(stdscr, "Searching...", (0, 0))
+    stdscr.refresh()
+    started = time.time()
+    # Pick up anything the metadata says was written since the index was
+    # last updated.
+    search_index.catch_up()
+    hits = search_index.search(query, max(1, curses.LINES - 4))
+    elapsed = (time.time() - started) * 1000
+    stdscr.clear()
+    safe_put(stdscr, "{n} match(es), best first, in {ms:.0f} ms. Hit any key to return to menu.".format(n=len(hits), ms=elapsed), (0, 1))
+    row = 2
+    words = list(search.words(query))
+    for score, name, (t, who, message) in hits:
+        line = u"{name} [{time}] {sender}: {text}".format(name=name.decode("utf-8", "replace"), time=time.strftime("%c", time.localtime(t)), sender=who.decode("utf-8", "replace"), text=search.snippet(message, words))
+        safe_put(stdscr, line[:curses.COLS - 2], (row, 1))
         row += 1
-    safe_put(stdscr, "Start typing a name: ", (row+1, column))
     stdscr.refresh()
+
+    # Wait for any key, then clear and return to menu.
+    stdscr.getch()
+    stdscr.clear()
+    stdscr.refresh()
+
+def conversation_row(info):
+    """
+    Describe a conversation for the list to choose from, given its
+    ConversationInfo.
+    """
+    unread = info.unread()
+    return "{mark} {name} {count} message(s){unread}, last {time}".format(
+        mark="*" if unread else " ", name=info.name.ljust(20), count=info.count,
+        unread=" ({0} unread)".format(unread) if unread else "",
+        time=time.strftime("%c", time.localtime(info.last)) if info.last else "never")
+
+def list_messages(stdscr):
+    """
+    List the conversations available to be read, from the metadata cache,
+    and prompt to read one. The list narrows to the names starting with
+    what's been typed, until only one is left.
+    """
+    info = filesystem.metadata.load()
+    if len(info) != len(conversation_names):
+        for name in info:
+            conversation_names.add(name)
+    curses.curs_set(1)
+    curses.noecho()
+    prompt = "Start typing a name: "
     selection = ""
-    possibilities = conversations
-    while len(possibilities) > 1:
-        selection += chr(stdscr.getch())
-        if selection.endswith("\n") and selection[:-1] in possibilities:
+    # The trie node for each prefix of the selection; None once nothing matches.
+    nodes = [conversation_names.root]
+    while nodes[-1] != None and nodes[-1].count > 1:
+        stdscr.erase()
+        safe_put(stdscr, "* marks a conversation with unread messages.", (1, 1))
+        row = 3
+        shown = 0
+        for name in nodes[-1].names(selection):
+            if row >= curses.LINES - 3:
+                break
+            safe_put(stdscr, conversation_row(info[name])[:curses.COLS - 2], (row, 1))
+            row += 1
+            shown += 1
+        if shown < nodes[-1].count:
+            safe_put(stdscr, "...and {n} more.".format(n=nodes[-1].count - shown), (row, 1))
+        safe_put(stdscr, prompt + selection, (curses.LINES - 2, 1))
+        stdscr.refresh()
+        c = stdscr.getch()
+        if c in (curses.KEY_BACKSPACE, 127, 8):
+            if len(nodes) > 1:
+                nodes.pop()
+                selection = selection[:-1]
+            continue
+        if c == ord("\n") and nodes[-1].end:
             # Hit enter to confirm the choice of a username when it's a
             # substring of another username.
-            possibilities = [selection[:-1]]
             break
-        possibilities = [p for p in possibilities if p.startswith(selection)]
+        if not 0 < c < 255:
+            continue
+        selection += chr(c)
+        nodes.append(nodes[-1].child(chr(c)))
     curses.curs_set(0)
-    curses.noecho()
     stdscr.clear()
     stdscr.refresh()
-    if possibilities:
-        read_message(stdscr, possibilities[0])
+    if nodes[-1] != None and nodes[-1].count:
+        # The selection itself comes first if it's a name.
+        read_message(stdscr, next(nodes[-1].names(selection)))
     else:
         print("No user matched '{selection}'".format(selection=selection))
 
+def message_rows(n, record, width):
+    """
+    Format message number n for display, as a list of (n, row) tuples of
+    rows no wider than width.
+    """
+    rows = []
+    text = store.format_record(record).rstrip("\n").replace("\r", "")
+    for line in text.split("\n"):
+        for i in range(0, max(len(line), 1), width):
+            rows.append((n, line[i:i+width]))
+    return rows
+
+def fill_window(conversation, end, height, width):
+    """
+    Read backwards from just before message number end until there are
+    enough rows to fill a window of the given height, and return them in a
+    deque of that size.
+    """
+    rows = []
+    n = end
+    while n > 0 and len(rows) < height:
+        n -= 1
+        rows[:0] = message_rows(n, conversation[n], width)
+    # Anything too much is cut off the top.
+    return collections.deque(rows, height)
+
 def read_message(stdscr, conversation):
     """
-    View the backlog of a specific message.
+    View the backlog of a specific conversation. Only enough messages to fill
+    the screen are read, starting with the newest; older ones are read as
+    they're scrolled back to.
     """
-    backlog = []
-    tail = filesystem.tail_conversation(conversation)
-    old_backlog = 0
+    name = conversation
+    conversation = filesystem.conversation_store(name)
+    watcher = filesystem.watch_conversation(name)
+    height = max(1, curses.LINES - 5)
+    width = max(1, curses.COLS - 1)
+    # The message after the last one in the window, and the rows on screen.
+    end = len(conversation)
+    window = fill_window(conversation, end, height, width)
+    # The most messages which have been on screen, to mark as read.
+    seen = end
+    following = True
+    shown = None
     while True:
         # These settings are inside the loop because the reply mode disables them.
         stdscr.nodelay(1)
         curses.noecho()
-        for line in tail:
-            if line:
-                backlog.append(line.replace("\r", ""))
-            else:
-                break
-        if old_backlog != len(backlog):
+        # Unless scrolled back, keep up with new messages.
+        if following:
+            length = len(conversation)
+            while end < length:
+                window.extend(message_rows(end, conversation[end], width))
+                end += 1
+            seen = max(seen, end)
+
+        if shown == None:
             stdscr.erase()
-            safe_put(stdscr, "Viewing conversation with {user}. You can (r)eply or (q)uit.".format(user=conversation), (2, 0))
-            safe_put(stdscr, "\r".join(backlog[-20:]), (4, 0))
-            stdscr.refresh()
-        old_backlog = len(backlog)
+            safe_put(stdscr, "Viewing conversation with {user}. You can (r)eply, scroll with the arrow and page keys, or (q)uit.".format(user=name), (2, 0))
+            shown = [None] * height
+        # Only rewrite the rows which changed.
+        rows = [row for n, row in window] + [""] * (height - len(window))
+        for i, row in enumerate(rows):
+            if shown[i] != row:
+                stdscr.move(4 + i, 0)
+                stdscr.clrtoeol()
+                if row:
+                    safe_put(stdscr, row, (4 + i, 0))
+                shown[i] = row
+        stdscr.refresh()
 
         selection = stdscr.getch()
         if selection == ord("q"):
             break
         if selection == ord("r"):
             stdscr.nodelay(0)
-            send_message(stdscr, conversation)
+            send_message(stdscr, name)
             # Trigger a redraw after sending a message
-            old_backlog = 0
-        time.sleep(0.1)
+            shown = None
+            continue
+        first = window[0][0] if window else 0
+        # Whether the top message is only partly on screen.
+        cut = bool(window) and len(message_rows(first, conversation[first], width)) > sum(1 for n, row in window if n == first)
+        if selection == curses.KEY_UP and end > 1 and (first > 0 or cut):
+            # Back one message.
+            end -= 1
+            following = False
+            window = fill_window(conversation, end, height, width)
+        elif selection == curses.KEY_PPAGE and (first > 0 or cut):
+            # Back a screen's worth, putting the top message at the bottom.
+            # If it was cut off, it stays on screen so the rest of it shows.
+            if cut and first < end - 1:
+                end = first + 1
+            elif first > 0:
+                end = first
+            following = False
+            window = fill_window(conversation, end, height, width)
+        elif selection in (curses.KEY_DOWN, curses.KEY_NPAGE) and end < len(conversation):
+            if selection == curses.KEY_DOWN:
+                end += 1
+            else:
+                end = min(len(conversation), end + len(set(n for n, row in window)))
+            following = end == len(conversation)
+            window = fill_window(conversation, end, height, width)
+        if selection == -1:
+            # Nothing to do until a key is pressed or a message arrives.
+            watcher.wait(None, [sys.stdin])
+    watcher.close()
+    conversation.close()
+    filesystem.metadata.mark_read(name, seen)
     stdscr.nodelay(0)
     stdscr.clear()
     stdscr.refresh()
@@ -208,7 +492,9 @@ def menu(stdscr):
     options["v"] = ("(V)iew user list", view_users)
     options["r"] = ("(R)ead messages", list_messages)
     options["s"] = ("(S)end a new message", send_message)
-    options["u"] = ("(U)pdate node status (slow!)", update_status)
+    options["u"] = ("(U)pdate node status", update_status)
+    options["o"] = ("View (o)utbox", view_outbox)
+    options["f"] = ("(F)ind messages", find_messages)
     while True:
         # Don't show the cursor or echo output.
         # These are inside the loop so menu items can unset them.
@@ -231,4 +517,6 @@ def menu(stdscr):
             options[chr(c)][1](stdscr)
 
 if __name__ == "__main__":
+    outbox_sender.start()
     curses.wrapper(menu)
+    outbox_sender.stop()
@@ -10,89 +10,723 @@ TauNet message. If successful, it writes the message into a file in the
 TauNet messages directory. If unsuccessful, it logs the reason.
 """
 
+import collections
+import errno
+import logging
+import multiprocessing
+import os
+import select
+import signal
 import socket
+import threading
+import time
+import traceback
+import Queue
 
 import taunet
 import filesystem
+import search
 
 
 # Network connection settings.
-MAX_QUEUE = 10
+MAX_QUEUE = socket.SOMAXCONN
+# Seconds a connection may stay open without sending its message.
+TIMEOUT = 3
+
+# Processes to decrypt and validate messages in. With 0, the main loop
+# does it itself.
+WORKERS = multiprocessing.cpu_count()
+
+# How long the writer waits for more messages before writing what it has,
+# how many conversations it keeps open, and whether each write is fsynced
+# (otherwise it's only flushed).
+WRITE_WINDOW = 0.02
+MAX_OPEN = 32
+SYNC = False
+
+# Admission control, checked before a connection is read from. Each address
+# may open RATE new connections per second on average, in bursts of up to
+# BURST_SECONDS' worth; hosts in the user table get KNOWN_RATE instead. A
+# rate of 0 means no limit. Past MAX_CONNECTIONS open at once, new ones are
+# turned away, and only the MAX_SOURCES most recent addresses are tracked.
+RATE = 1
+KNOWN_RATE = 10
+BURST_SECONDS = 5
+MAX_CONNECTIONS = 128
+MAX_SOURCES = 4096
+
+# Where the statistics are written (on SIGUSR1, every STATS_INTERVAL
+# seconds, and at exit).
+STATS_FILE = os.path.join(filesystem.TAURUS_DIR, "taurusd.stats")
+STATS_INTERVAL = 60
+
+# Running counts of what the listener has seen. The main loop, the thread
+# which handles workers' results and the writer all add to these (and to
+# timings, below), so they only change with stats_lock held.
+stats = collections.Counter()
+stats_lock = threading.Lock()
+
+# Signals which have arrived and not been acted on yet. The handlers only
+# add to this, and the main loop does the work, since a handler could
+# otherwise interrupt the code it's about to call (logging, say) halfway
+# through and deadlock on its lock.
+pending_signals = []
+
+# The QueueHandler logging goes through, once the daemon has switched to it,
+# for its count of records dropped because the queue was full.
+log_handler = [None]
 
 # Get our logger object.
 logger=filesystem.get_logger("taurusd")
 
 
-def main_loop():
-    logger.info("Starting main loop.")
-    conn = None
+class Histogram(object):
+    """
+    A distribution of durations, counted in buckets which each cover twice
+    the range of the one before: bucket n holds durations of at least
+    2**(n-1) and less than 2**n microseconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.Counter()
+
+    def add(self, seconds):
+        """
+        Count one duration.
+        """
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[int(max(0, seconds) * 1000000).bit_length()] += 1
+
+    def percentile(self, p):
+        """
+        Return the upper bound, in seconds, of the bucket containing the
+        pth percentile.
+        """
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen * 100 >= p * self.count:
+                return (2 ** bucket) / 1000000.0
+        return 0.0
+
+    def summary(self):
+        """
+        Describe the distribution in one line, in milliseconds.
+        """
+        if not self.count:
+            return "none"
+        return "count {n}, mean {mean:.3f} ms, 50% < {p50:.3f} ms, 90% < {p90:.3f} ms, 99% < {p99:.3f} ms, max {max:.3f} ms".format(
+            n=self.count, mean=self.total / self.count * 1000, p50=self.percentile(50) * 1000,
+            p90=self.percentile(90) * 1000, p99=self.percentile(99) * 1000, max=self.max * 1000)
+
+
+# How long each stage of handling a message takes, and how long messages
+# took to be discarded for each reason, by name.
+timings = collections.defaultdict(Histogram)
+
+
+def count(name, n = 1):
+    """
+    Add n to the named counter.
+    """
+    with stats_lock:
+        stats[name] += n
+
+
+def record(stage, seconds):
+    """
+    Add a duration to the stage's histogram.
+    """
+    with stats_lock:
+        timings[stage].add(seconds)
+
+
+def discard(reason, accepted):
+    """
+    Count a discarded message, and how long it was from being accepted to
+    being discarded, under the given reason.
+    """
+    count("discarded ({0})".format(reason))
+    record("discarded ({0})".format(reason), time.time() - accepted)
+
+
+def format_stats():
+    """
+    Return the counters and histograms as a list of lines of text.
+    """
+    with stats_lock:
+        lines = ["{0}: {1}".format(name, stats[name]) for name in sorted(stats)]
+        lines.extend("{0} time: {1}".format(name, timings[name].summary()) for name in sorted(timings))
+    if log_handler[0] != None:
+        lines.append("log records dropped: {0}".format(log_handler[0].dropped))
+    return lines
+
+
+def dump_stats(log = False):
+    """
+    Write the statistics to STATS_FILE, replacing what was there, and log
+    them too if log is true.
+    """
+    lines = format_stats()
+    try:
+        with open(STATS_FILE + ".tmp", "w") as f:
+            f.write("Statistics at {0}\n".format(time.ctime()))
+            f.write("".join(line + "\n" for line in lines))
+        os.rename(STATS_FILE + ".tmp", STATS_FILE)
+    except (IOError, OSError) as e:
+        logger.error("Couldn't write statistics to %s: %s", STATS_FILE, str(e))
+    if log:
+        for line in lines:
+            logger.info("Statistics: %s", line)
+
+
+def flag_signal(signum, frame):
+    """
+    Signal handler for SIGUSR1, SIGUSR2 and SIGTERM, which leaves them for
+    the main loop to act on (see handle_signals).
+    """
+    pending_signals.append(signum)
+
+
+def handle_signals():
+    """
+    Act on any signals which have arrived: SIGUSR1 dumps the statistics to
+    the log and the stats file, and SIGUSR2 switches debug logging on or
+    off. Returns True if SIGTERM arrived, so the main loop should shut down.
+    """
+    terminate = False
+    while pending_signals:
+        signum = pending_signals.pop(0)
+        if signum == signal.SIGUSR1:
+            dump_stats(True)
+        elif signum == signal.SIGUSR2:
+            toggle_debug()
+        elif signum == signal.SIGTERM:
+            terminate = True
+    return terminate
+
+
+def check_message(data, sender, dispatched = None):
+    """
+    Run received data through the full validation chain. This is the
+    expensive part of handling a message, and is safe to run in a worker
+    process. Only the headers are decrypted until they've passed every
+    check, so a message which is turned away on them costs less (though the
+    key scheduling, which is most of the work, can't be skipped).
+
+    Returns a tuple of:
+    - the TauNetMessage, or None if it should be discarded;
+    - a list of (level, message, args) tuples which should be logged about
+      it (formatting is left to the logger);
+    - a dictionary of counts to add to the stats;
+    - a dictionary of how many seconds each stage took, including the wait
+      since dispatched, if that time is given;
+    - the reason it was discarded, or None.
+
+    Nothing is raised: an unexpected error discards the message, with the
+    reason "error" and the traceback logged, since an exception in a worker
+    would otherwise lose it without a trace.
+    """
+    log = []
+    counts = {}
+    timings = {}
+    if dispatched != None:
+        timings["queue"] = time.time() - dispatched
+    try:
+        return _check_message(data, sender, log, counts, timings)
+    except Exception:
+        log.append((logging.ERROR, "Error checking a message from %s, discarding:\n%s", (sender, traceback.format_exc())))
+        return None, log, {}, timings, "error"
+
+
+def _check_message(data, sender, log, counts, timings):
+    """
+    Do the work of check_message(), adding to the log, counts and timings
+    given.
+    """
+    tnm = taunet.TauNetMessage()
+    try:
+        tnm.incoming_headers(data, timings)
+    except taunet.TauNetError as e:
+        log.append((logging.WARNING, "Got a badly-formed message ('%s'). Discarding.", (str(e),)))
+        if tnm.undecrypted():
+            counts["rejected on headers"] = 1
+            counts["bytes not decrypted"] = tnm.undecrypted()
+        return None, log, counts, timings, "badly formed"
+    reason = check_headers(tnm, sender, log, timings)
+    if reason:
+        counts["rejected on headers"] = 1
+        counts["bytes not decrypted"] = tnm.undecrypted()
+        return None, log, counts, timings, reason
+    tnm.incoming_message(timings)
+    if not tnm.message:
+        log.append((logging.INFO, "Discarding zero-length message.", ()))
+        return None, log, counts, timings, "empty"
+    if tnm.version != taunet.VERSION:
+        # If it got this far, nothing seems to be wrong with it. Warn, but keep.
+        log.append((logging.WARNING, "Incoming message version doesn't match ours; may be malformed.", ()))
+    return tnm, log, counts, timings, None
+
+
+def check_headers(tnm, sender, log, timings):
+    """
+    Check that a message whose headers have been read is addressed to us,
+    from a known user, at their host. If not, add the reason to log and
+    return a short version of it for the stats. The seconds spent checking
+    the user table and looking up hosts are added to timings as "lookup"
+    and "dns".
+    """
+    if tnm.recipient != taunet.USERNAME:
+        log.append((logging.WARNING, "Got a message for a user who's not us (%s), discarding.", (tnm.recipient,)))
+        return "not for us"
+    started = time.time()
+    tnu = taunet.users.by_name(tnm.sender)
+    # Usually the sender's address is already known to belong to them, and
+    # there's nothing to look up.
+    known = tnu != None and tnu in taunet.users.by_address(sender[0])
+    timings["lookup"] = time.time() - started
+    if tnu == None:
+        log.append((logging.WARNING, "Got a message from an unknown user (%s), discarding.", (tnm.sender,)))
+        return "unknown sender"
+    if not known:
+        started = time.time()
+        try:
+            correct_origin = taunet.users.resolve(tnu)
+        except socket.error as e:
+            log.append((logging.WARNING, "Couldn't look up the host of a known user (%s): %s. Discarding.", (tnm.sender, str(e))))
+            return "lookup failed"
+        finally:
+            timings["dns"] = time.time() - started
+    else:
+        correct_origin = sender[0]
+    if sender[0] != correct_origin:
+        log.append((logging.WARNING, "Got a message from a known user (%s) at the wrong host (%s instead of %s), discarding.", (tnm.sender, sender[0], correct_origin)))
+        return "wrong host"
+    return None
+
+
+def deliver(result, writer, accepted):
+    """
+    Log what check_message had to say about a message, add its counts and
+    timings to the stats, and, if it passed, hand it to the writer. This
+    runs in one thread no matter how many workers there are. accepted is
+    the time its connection was accepted.
+    """
+    tnm, log, counts, stage_timings, reason = result
+    for level, message, args in log:
+        logger.log(level, message, *args)
+    for name, n in counts.items():
+        count(name, n)
+    for stage, seconds in stage_timings.items():
+        record(stage, seconds)
+    if tnm == None:
+        discard(reason, accepted)
+        return
+
+    # Hooray! We got a nice message!
+    writer.put(tnm, accepted)
+
+
+class Writer(object):
+    """
+    Writes incoming messages to their conversations from a thread of its
+    own. Messages which arrive within WRITE_WINDOW of each other are written
+    together, with one locked write per conversation, and the files of the
+    MAX_OPEN most recently written conversations are kept open.
+    """
+    def __init__(self, sync = SYNC):
+        self.sync = sync
+        self.queue = Queue.Queue()
+        self.files = collections.OrderedDict()
+        self.thread = threading.Thread(target=self.run, name="writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, tnm, accepted = None):
+        """
+        Queue a TauNetMessage to be written. If the time its connection was
+        accepted is given, the time from then until it's written is counted
+        as its "total" time.
+        """
+        self.queue.put((tnm, accepted))
+
+    def stop(self):
+        """
+        Write anything still queued, close the files, and stop.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """
+        Collect batches of messages and write them, until stopped.
+        """
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.time() + WRITE_WINDOW
+            while batch[-1] != None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+            if batch[-1] == None:
+                running = False
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception("Failed to write %d message(s).", len(batch))
+        for conversation, files in self.files.items():
+            for f in files:
+                f.close()
+        self.files.clear()
+
+    def write(self, batch):
+        """
+        Write a batch of TauNetMessages, grouped by conversation, and add
+        them to the metadata cache and the search index.
+        """
+        conversations = collections.OrderedDict()
+        for tnm, accepted in batch:
+            conversations.setdefault(tnm.sender, []).append((None, tnm.sender, tnm.message))
+        count("batches")
+        for name, records in conversations.items():
+            started = time.time()
+            # One conversation failing to write shouldn't lose the rest.
+            try:
+                conversation = filesystem.conversation_store(name)
+                conversation.append_many(records, self.open(name, conversation), self.sync)
+            except Exception:
+                logger.exception("Failed to write %d message(s) to %s.", len(records), name)
+                count("write errors")
+                # Open them afresh next time, in case they're what failed.
+                for f in self.files.pop(name, ()):
+                    f.close()
+                continue
+            try:
+                filesystem.metadata.written(name, conversation)
+            except (IOError, OSError, ValueError):
+                logger.exception("Failed to update the metadata for %s.", name)
+            record("write", time.time() - started)
+            for r in records:
+                logger.info("Wrote message to %s.", conversation.data_path)
+        now = time.time()
+        for tnm, accepted in batch:
+            if accepted != None:
+                record("total", now - accepted)
+        started = time.time()
+        try:
+            search.update(conversations.keys())
+        except Exception:
+            logger.exception("Failed to update the search index.")
+        record("index", time.time() - started)
+
+    def open(self, name, conversation):
+        """
+        Return the open (data, index) files of a conversation, opening them
+        if need be and closing the least recently used if too many are open.
+        """
+        files = self.files.pop(name, None)
+        if files == None:
+            files = conversation.open_append()
+            while len(self.files) >= MAX_OPEN:
+                for f in self.files.popitem(last=False)[1]:
+                    f.close()
+        self.files[name] = files
+        return files
+
+
+def toggle_debug():
+    """
+    Switch between logging everything and leaving out debug messages.
+    """
+    level = logging.INFO if logging.getLogger().isEnabledFor(logging.DEBUG) else logging.DEBUG
+    filesystem.set_log_level(level)
+    logger.info("Log level is now %s.", logging.getLevelName(level))
+
+
+def init_worker():
+    """
+    Set up a worker process. Interrupts are left to the main loop, which
+    shuts the workers down itself, and workers have no statistics of their
+    own to show. Each worker keeps its own host addresses fresh, and writes
+    its own log, since threads (including the one which writes the daemon's
+    log) don't survive the fork.
+    """
+    filesystem.log_to_file()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    # The pool stops workers with SIGTERM if it has to.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    taunet.users.start_refresh()
+
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average, and bursts of up to burst
+    events at once. It starts out full.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        """
+        Use up a token if there is one, and return whether there was.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Limiter(object):
+    """
+    Rate limits new connections with a TokenBucket for each source address.
+    Addresses which belong to hosts in the user table get known_rate rather
+    than rate. Buckets are kept for the MAX_SOURCES most recently seen
+    addresses.
+    """
+    def __init__(self, rate = RATE, known_rate = KNOWN_RATE):
+        self.rate = rate
+        self.known_rate = known_rate
+        self.buckets = collections.OrderedDict()
+
+    def admit(self, address, now = None):
+        """
+        Return whether a new connection from the given address is allowed.
+        """
+        if now == None:
+            now = time.time()
+        rate = self.known_rate if taunet.users.by_address(address) else self.rate
+        if not rate:
+            return True
+        bucket = self.buckets.pop(address, None)
+        if bucket == None or bucket.rate != rate:
+            bucket = TokenBucket(rate, rate * BURST_SECONDS, now)
+            while len(self.buckets) >= MAX_SOURCES:
+                self.buckets.popitem(last=False)
+        self.buckets[address] = bucket
+        return bucket.take(now)
+
+
+class Connection(object):
+    """
+    An open connection from a peer, and the buffer its message is being read
+    into. The buffer has room for one byte more than the largest allowed
+    message, so that oversized ones can be noticed.
+    """
+    def __init__(self, conn, sender):
+        self.conn = conn
+        self.sender = sender
+        self.accepted = time.time()
+        self.deadline = self.accepted + TIMEOUT
+        self.buf = bytearray(taunet.MAX_TNM + 1)
+        self.view = memoryview(self.buf)
+        self.received = 0
+        self.reads = 0
+
+    def read(self):
+        """
+        Read whatever has arrived into the buffer. Returns True when the frame
+        is finished: the peer has shut down its end, or the buffer is full.
+        """
+        try:
+            n = self.conn.recv_into(self.view[self.received:])
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            return True
+        self.reads += 1
+        self.received += n
+        return n == 0 or self.received == len(self.buf)
+
+    def data(self):
+        """
+        Return the bytes received so far.
+        """
+        return self.view[:self.received].tobytes()
+
+    def close(self):
+        """
+        Shut down and close the socket, ignoring errors from peers which have
+        already gone away.
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.conn.close()
+
+
+def main_loop(workers = WORKERS, port = taunet.PORT, sync = SYNC, rate = RATE, known_rate = KNOWN_RATE, max_connections = MAX_CONNECTIONS):
+    logger.info("Starting main loop with %d worker(s).", workers)
+    writer = Writer(sync)
+    limiter = Limiter(rate, known_rate)
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers, init_worker)
+    # The limiter needs known hosts' addresses here too.
+    taunet.users.start_refresh()
+    # If the metadata cache has to be built from scratch, that has to happen
+    # before anything is written, or new messages would be taken as read.
+    filesystem.metadata.load()
+    # Open connections, by file descriptor.
+    connections = {}
+
+    def finish(c):
+        """
+        Close a connection and pass along whatever it sent.
+        """
+        c.close()
+        record("recv", time.time() - c.accepted)
+        if not c.received:
+            # The error message is here instead of above because the
+            # exception isn't always raised.
+            logger.debug("Connection from %s timed out.", c.sender)
+            count("empty connections")
+            return
+        count("frames")
+        if c.reads > 2:
+            # One read for the data and one for the shutdown is normal.
+            count("partial reads")
+        if c.received > taunet.MAX_TNM:
+            count("oversize frames")
+            logger.warning("Got a message over %d bytes from %s, discarding.", taunet.MAX_TNM, c.sender)
+            discard("oversize", c.accepted)
+            return
+        if pool:
+            pool.apply_async(check_message, (c.data(), c.sender, time.time()), callback=lambda result: deliver(result, writer, c.accepted))
+        else:
+            deliver(check_message(c.data(), c.sender), writer, c.accepted)
+
     try:
         listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         assert listener, "Couldn't create listening socket."
-        # Block until someone connects to us.
-        listener.settimeout(None)
+        # Never block in accept; the poll below says when someone's waiting.
+        listener.setblocking(0)
+        # Closed connections linger in TIME_WAIT; don't let them keep us from
+        # binding again after a restart.
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Empty host means "all available interfaces."
-        listener.bind(('', taunet.PORT))
+        listener.bind(('', port))
         listener.listen(MAX_QUEUE)
+        poller = select.poll()
+        poller.register(listener, select.POLLIN)
+        next_dump = time.time() + STATS_INTERVAL
 
         while True:
-            # Not redundant. The first initialization of conn is so that it can
-            # be tested in the finally block even if an exception is raised
-            # before now, this one is so it happens in every loop iteration.
-            conn = None
-            conn, sender = listener.accept()
-            assert conn, "Failed to make connection socket"
-            assert sender, "Made connection, but have no sender"
-            logger.debug("Got a connection from {sender}.".format(sender=sender))
-            # Don't block when connected; time out if we get no data.
-            conn.settimeout(3)
+            if handle_signals():
+                logger.info("Terminated.")
+                break
+            if time.time() >= next_dump:
+                dump_stats()
+                next_dump = time.time() + STATS_INTERVAL
+            # Sleep until something happens, the next connection expires, or
+            # it's time to write the stats file.
+            deadline = next_dump
+            if connections:
+                deadline = min(deadline, min(c.deadline for c in connections.values()))
+            timeout = max(0, (deadline - time.time()) * 1000)
             try:
-                data = conn.recv(taunet.BUF_SIZE)
-            except socket.timeout:
-                data = None
-
-            if not data:
-                # The error message is here instead of above because the
-                # exception isn't always raised.
-                logger.debug("Connection from {sender} timed out.".format(sender=sender))
-                continue
+                events = poller.poll(timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
 
-            try:
-                tnm = taunet.TauNetMessage().incoming(data)
-            except taunet.TauNetError as e:
-                logger.warning("Got a badly-formed message ('{error}'). Discarding.".format(error=str(e)))
-                continue
-            if not tnm.message:
-                logger.info("Discarding zero-length message.")
-                continue
-            if tnm.recipient != taunet.USERNAME:
-                logger.warning("Got a message for a user who's not us ({user}), discarding.".format(user=tnm.recipient))
-                continue
-            tnu = taunet.users.by_name(tnm.sender)
-            if tnu == None:
-                logger.warning("Got a message from an unknown user ({user}), discarding.".format(user=tnm.sender))
-                continue
-            correct_origin = socket.gethostbyname(tnu.host)
-            if sender[0] != correct_origin:
-                logger.warning("Got a message from a known user ({user}) at the wrong host ({wrong} instead of {right}), discarding.".format(user=tnm.sender, wrong=sender[0], right=correct_origin))
-                continue
-            if tnm.version != taunet.VERSION:
-                # If it got this far, nothing seems to be wrong with it. Warn, but keep.
-                logger.warning("Incoming message version doesn't match ours; may be malformed.")
+            for fd, event in events:
+                if fd == listener.fileno():
+                    # Take everyone who's waiting, not just the first.
+                    while True:
+                        started = time.time()
+                        try:
+                            conn, sender = listener.accept()
+                        except socket.error as e:
+                            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                break
+                            raise
+                        assert conn, "Failed to make connection socket"
+                        assert sender, "Made connection, but have no sender"
+                        # Turn away whoever's over the limits before reading
+                        # anything from them.
+                        if len(connections) >= max_connections:
+                            count("rejected")
+                            logger.debug("Too many open connections; turning away %s.", sender)
+                            conn.close()
+                            continue
+                        if not limiter.admit(sender[0]):
+                            count("throttled")
+                            logger.debug("Too many connections from %s; turning it away.", sender[0])
+                            conn.close()
+                            continue
+                        count("accepted")
+                        logger.debug("Got a connection from %s.", sender)
+                        conn.setblocking(0)
+                        connections[conn.fileno()] = Connection(conn, sender)
+                        poller.register(conn, select.POLLIN)
+                        record("accept", time.time() - started)
+                    continue
 
-            # Hooray! We got a nice message!
-            filename = filesystem.write_message(tnm.sender, tnm)
-            logger.info("Wrote message to {filename}.".format(filename=filename))
+                c = connections[fd]
+                if c.read():
+                    del connections[fd]
+                    poller.unregister(fd)
+                    finish(c)
+
+            # Peers which never shut down their end get whatever they've sent
+            # so far treated as the whole message once they run out of time.
+            now = time.time()
+            for fd, c in list(connections.items()):
+                if c.deadline <= now:
+                    del connections[fd]
+                    poller.unregister(fd)
+                    finish(c)
 
     # Will catch socket.error later; right now we want it to blow us up.
     except KeyboardInterrupt:
         logger.info("Killed.")
     finally:
-        if conn:
-            logger.info("Closing open socket.")
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+        if connections:
+            logger.info("Closing open sockets.")
+        for c in connections.values():
+            c.close()
+        if pool:
+            # Let the workers finish what they've already been given.
+            pool.close()
+            pool.join()
+        writer.stop()
+        dump_stats(True)
 
 
 if __name__ == "__main__":
-    main_loop()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Listen for TauNet messages and write them to the messages directory.")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS, help="Number of processes to decrypt messages in, or 0 to do it in the main loop (default {}).".format(WORKERS))
+    parser.add_argument("-p", "--port", type=int, default=taunet.PORT, help="Port to listen on (default {}).".format(taunet.PORT))
+    parser.add_argument("--fsync", action="store_true", default=SYNC, help="Sync each batch of messages to disk, instead of only flushing it.")
+    parser.add_argument("--rate", type=float, default=RATE, help="New connections per second allowed from each unknown address, or 0 for no limit (default {}).".format(RATE))
+    parser.add_argument("--known-rate", type=float, default=KNOWN_RATE, help="New connections per second allowed from each user table host, or 0 for no limit (default {}).".format(KNOWN_RATE))
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="Most connections to have open at once (default {}).".format(MAX_CONNECTIONS))
+    parser.add_argument("--log-level", default=None, choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Only log messages of this level and up. (Send SIGUSR2 to switch debug messages on and off while running.)")
+    args = parser.parse_args()
+    log_handler[0] = filesystem.start_log_queue()
+    if args.log_level:
+        filesystem.set_log_level(getattr(logging, args.log_level))
+    signal.signal(signal.SIGUSR1, flag_signal)
+    signal.signal(signal.SIGUSR2, flag_signal)
+    # Shut down as for an interrupt, writing out whatever has been received.
+    signal.signal(signal.SIGTERM, flag_signal)
+    main_loop(args.workers, args.port, args.fsync, args.rate, args.known_rate, args.max_connections)
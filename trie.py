@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+"""
+Copyright (c) 2015 Finn Ellis, licensed under the MIT License.
+(See accompanying LICENSE file for details.)
+
+A prefix tree of names, for completing them as they're typed. Each node
+knows how many names are below it, so narrowing the choices by one more
+character, and telling whether the choice is down to one, takes the same
+time however many names there are.
+"""
+
+
+class TrieNode(object):
+    """
+    The names sharing one prefix: a child for each character which can come
+    next, whether the prefix is itself a name, and how many names start with
+    it.
+    """
+    __slots__ = ("children", "end", "count")
+
+    def __init__(self):
+        self.children = {}
+        self.end = False
+        self.count = 0
+
+    def child(self, character):
+        """
+        Return the node for this prefix followed by character, or None if no
+        name continues that way.
+        """
+        return self.children.get(character)
+
+    def names(self, prefix = ""):
+        """
+        Yield the names below this node in sorted order, given the prefix
+        which leads to it.
+        """
+        if self.end:
+            yield prefix
+        for character in sorted(self.children):
+            for name in self.children[character].names(prefix + character):
+                yield name
+
+
+class Trie(object):
+    """
+    A set of names which can be listed or counted by prefix.
+    """
+    def __init__(self, names = ()):
+        self.root = TrieNode()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """
+        Add a name, if it isn't there already.
+        """
+        if name in self:
+            return
+        node = self.root
+        node.count += 1
+        for character in name:
+            node = node.children.setdefault(character, TrieNode())
+            node.count += 1
+        node.end = True
+
+    def find(self, prefix):
+        """
+        Return the node for a prefix, or None if no name starts with it.
+        """
+        node = self.root
+        for character in prefix:
+            node = node.children.get(character)
+            if node == None:
+                return None
+        return node
+
+    def complete(self, prefix = "", limit = None):
+        """
+        Return a sorted list of the names starting with prefix, or the first
+        limit of them.
+        """
+        node = self.find(prefix)
+        if node == None:
+            return []
+        names = []
+        for name in node.names(prefix):
+            if limit != None and len(names) >= limit:
+                break
+            names.append(name)
+        return names
+
+    def __contains__(self, name):
+        node = self.find(name)
+        return node != None and node.end
+
+    def __len__(self):
+        return self.root.count
+
+
+def run_tests():
+    """
+    Tests for adding, counting and completing names.
+    """
+    print("-- Testing adding. --")
+    names = Trie(["bob", "alice", "al", "alicia"])
+    assert len(names) == 4
+    names.add("alice")
+    assert len(names) == 4
+    print("Adding a name twice counts it once.")
+    assert "al" in names and "alice" in names
+    assert "ali" not in names and "zed" not in names and "" not in names
+    print("Only whole names are in the trie, not their prefixes.")
+    assert names.find("al").count == 3
+    assert names.find("ali").count == 2
+    assert names.find("b").count == 1
+    assert names.find("z") == None
+    print("Each prefix counts the names starting with it.")
+    assert names.find("al").child("i") is names.find("ali")
+    assert names.find("al").child("x") == None
+    print("Children narrow the prefix by one character.")
+
+    print("-- Testing completion. --")
+    assert names.complete() == ["al", "alice", "alicia", "bob"]
+    assert names.complete("al") == ["al", "alice", "alicia"]
+    print("Completions come in sorted order, including the prefix itself.")
+    assert names.complete("ali", 1) == ["alice"]
+    print("The limit keeps the first completions.")
+    assert names.complete("x") == []
+    print("An unknown prefix has no completions.")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="A prefix tree for completing names.")
+    parser.add_argument("-t", "--test", action="store_true", help="Run tests and exit.")
+    if parser.parse_args().test:
+        run_tests()
+    else:
+        parser.print_help()